@@ -22,7 +22,7 @@ class APICascadedEmbeddings(APIMaybeExtendTrainWithClassifier):
         for i in input_size:
             embedders.append(self.inheriter.get_embedder_model(model_type, input_size=i, output_size=output_size))
         self.all_embedding_sizes = [c_f.get_last_linear(embedders[0]).out_features] * len(embedders)
-        model = arch.misc_models.ListOfModels(embedders, input_size)
+        model = arch.misc_models.ListOfModels(embedders, input_size, stack_identical_mlps=getattr(self.args, "stack_identical_mlps", False))
         return model
 
     def get_trunk_model(self, model_type):
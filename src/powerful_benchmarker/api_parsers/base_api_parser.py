@@ -1,22 +1,37 @@
 import sys
 import copy
-from ..utils import common_functions as c_f, dataset_utils as d_u, constants as const
+from ..utils import common_functions as c_f, dataset_utils as d_u, constants as const, trunk_feature_cache, embedding_store, untrained_eval_cache, multi_model_eval, background_eval, eval_tensor_cache, streamed_embeddings, startup_profile, experiment_manifest, checkpoint_writer, tensor_store
 from pytorch_metric_learning import losses
-import pytorch_metric_learning.utils.logging_presets as logging_presets
 import pytorch_metric_learning.utils.common_functions as pml_cf
 from easy_module_attribute_getter import utils as emag_utils
-from torch.utils.tensorboard import SummaryWriter
 import torch.nn
 import torch
 import os
-import pathlib
+import json
 import shutil
 import logging
 import numpy as np
-from scipy import stats as scipy_stats
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 from .. import architectures
 
+# Set right before forking the split scheme processes, so that they inherit the api parser without pickling it.
+_API_PARSER_FOR_SUBPROCESSES = None
+
+def _run_split_scheme_in_subprocess(curr_split_count, split_scheme_name, num_threads):
+    api_parser = _API_PARSER_FOR_SUBPROCESSES
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    api_parser.curr_split_count = curr_split_count
+    api_parser.meta_accuracies = defaultdict(lambda: defaultdict(lambda: defaultdict(dict)))
+    api_parser.run_split_scheme(split_scheme_name)
+    # only this split scheme's record keeper, because the meta record keeper's writer thread doesn't exist in a forked process
+    api_parser.record_keeper.save_records()
+    api_parser.record_keeper.tensorboard_writer.flush()
+    api_parser.record_keeper.tensorboard_writer.close()
+    return c_f.nested_defaultdict_to_dict(api_parser.meta_accuracies)
+
 
 class BaseAPIParser:
     def __init__(self, args, pytorch_getter, global_db_path=None):
@@ -38,6 +53,11 @@ class BaseAPIParser:
         }
 
         self.trainer, self.tester = None, None
+        self.trunk_for_cached_features = None
+        self.eval_tensor_datasets = {}
+        self.pristine_trunk_models = {}
+        self.checkpoint_writer = None
+        self.tensor_store = None
 
     def run(self):
         if self.beginning_of_training():
@@ -78,17 +98,55 @@ class BaseAPIParser:
             return self.return_val_accuracy_and_standard_error()
 
     def run_for_each_split_scheme(self):
+        if self.get_num_parallel_split_schemes() > 1:
+            self.run_split_schemes_in_parallel()
+            return
         for self.curr_split_count, split_scheme_name in enumerate(self.split_manager.split_scheme_names):
-            num_epochs = self.num_epochs[split_scheme_name]
-            self.split_manager.set_curr_split_scheme(split_scheme_name)
-            self.set_curr_folders()
-            self.set_models_optimizers_losses()
-            if self.args.evaluate:
-                self.eval()
-            elif self.should_train(num_epochs, split_scheme_name):
-                self.train(num_epochs)
-            self.update_meta_record_keeper(split_scheme_name)
-            self.delete_old_objects()
+            self.run_split_scheme(split_scheme_name)
+
+    def run_split_scheme(self, split_scheme_name):
+        num_epochs = self.num_epochs[split_scheme_name]
+        self.split_manager.set_curr_split_scheme(split_scheme_name)
+        self.set_curr_folders()
+        self.set_models_optimizers_losses()
+        if getattr(self.args, "profile_startup", False):
+            startup_profile.report()
+        if self.args.evaluate:
+            self.eval()
+        elif self.should_train(num_epochs, split_scheme_name):
+            self.train(num_epochs)
+        self.update_meta_record_keeper(split_scheme_name)
+        self.delete_old_objects()
+
+    def get_num_parallel_split_schemes(self):
+        num_parallel = min(getattr(self.args, "parallel_split_schemes", 1) or 1, self.split_manager.num_split_schemes)
+        if num_parallel > 1 and torch.cuda.is_initialized():
+            logging.warning("CUDA has already been initialized, so split schemes can't be run in forked processes. They will be run sequentially.")
+            return 1
+        return num_parallel
+
+    # Each split scheme runs in a forked process, with its own models, record keeper, and folders.
+    # The processes return their meta accuracies, which are merged into self.meta_accuracies.
+    def run_split_schemes_in_parallel(self):
+        global _API_PARSER_FOR_SUBPROCESSES
+        num_parallel = self.get_num_parallel_split_schemes()
+        num_threads = getattr(self.args, "num_threads_per_split_scheme", None)
+        if num_threads is None:
+            num_threads = max(1, (os.cpu_count() or 1) // num_parallel)
+        logging.info("Running {} split schemes at a time, with {} threads each".format(num_parallel, num_threads))
+        _API_PARSER_FOR_SUBPROCESSES = self
+        try:
+            with ProcessPoolExecutor(num_parallel, mp_context=multiprocessing.get_context("fork")) as pool:
+                futures = {}
+                for curr_split_count, split_scheme_name in enumerate(self.split_manager.split_scheme_names):
+                    futures[split_scheme_name] = pool.submit(_run_split_scheme_in_subprocess, curr_split_count, split_scheme_name, num_threads)
+                for split_scheme_name, future in futures.items():
+                    for split, x in future.result().items():
+                        for trained_status, y in x.items():
+                            for k, z in y.items():
+                                self.meta_accuracies[split][trained_status][k].update(z)
+        finally:
+            _API_PARSER_FOR_SUBPROCESSES = None
 
     def delete_old_objects(self):
         for attr_name in ["models", "loss_funcs", "mining_funcs", "optimizers", "lr_schedulers", "gradient_clippers"]:
@@ -111,13 +169,12 @@ class BaseAPIParser:
         return (not self.args.resume_training) and (not self.args.evaluate)
 
     def make_dir(self):
-        root = pathlib.Path(self.experiment_folder)
-        non_empty_dirs = {str(p.parent) for p in root.rglob('*') if p.is_file()}
-        non_empty_dirs.discard(self.experiment_folder)
-        if len(non_empty_dirs) > 0:
+        # experiments that were created before the manifest existed are checked by walking the folder
+        if experiment_manifest.load_manifest(self.experiment_folder) is not None or c_f.has_files_in_subfolders(self.experiment_folder):
             logging.info("Experiment folder already taken!")
             sys.exit()
         c_f.makedir_if_not_there(self.experiment_folder)
+        experiment_manifest.create_manifest(self.experiment_folder)
 
     def make_sub_experiment_dirs(self):
         for s in self.sub_experiment_dirs.values():
@@ -141,7 +198,7 @@ class BaseAPIParser:
             self.num_epochs = self.args.num_epochs_train
 
     def save_config_files(self):
-        self.latest_sub_experiment_epochs = c_f.latest_sub_experiment_epochs(self.get_sub_experiment_dir_paths())
+        self.latest_sub_experiment_epochs = c_f.latest_sub_experiment_epochs(self.get_sub_experiment_dir_paths(), self.experiment_folder)
         latest_epochs = list(self.latest_sub_experiment_epochs.values())
         if self.is_training():
             c_f.save_config_files(self.args.place_to_save_configs, self.args.dict_of_yamls, self.args.resume_training, latest_epochs)
@@ -157,6 +214,8 @@ class BaseAPIParser:
     def set_optimizers(self):
         self.optimizers, self.lr_schedulers, self.gradient_clippers = {}, {}, {}
         for k, v in self.args.optimizers.items():
+            if k == "trunk_optimizer" and self.trunk_for_cached_features is not None:
+                continue
             basename = k.replace("_optimizer", '')
             param_source = None
             for possible_params in [self.models, self.loss_funcs]:
@@ -182,6 +241,7 @@ class BaseAPIParser:
 
     def set_split_manager(self):
         self.split_manager = self.get_split_manager()
+        self.split_manager.split_indices_path = os.path.join(self.experiment_folder, "split_schemes.npz")
 
         if self.args.multi_dataset is not None:
             chosen_dataset, original_dataset_params = {}, {}
@@ -193,24 +253,97 @@ class BaseAPIParser:
             chosen_dataset = {k:chosen_dataset for k in self.split_manager.split_names}
             original_dataset_params = {k:original_dataset_params for k in self.split_manager.split_names}
 
-        datasets = defaultdict(dict)
-        for transform_type, T in self.get_transforms().items():
-            logging.info("{} transform: {}".format(transform_type, T))
-            for split_name in self.split_manager.split_names:
-                dataset_params = copy.deepcopy(original_dataset_params[split_name])
-                dataset_params["transform"] = T
-                if "root" not in dataset_params:
-                    dataset_params["root"] = self.args.dataset_root            
-                datasets[transform_type][split_name] = chosen_dataset[split_name](**dataset_params)
+        # Each dataset is constructed only once. The (transform_type, split_name) views
+        # are shallow copies that share paths and labels, but have their own transform.
+        with startup_profile.section("dataset construction"):
+            shared_datasets = self.get_shared_datasets(chosen_dataset, original_dataset_params)
+            transforms = self.get_transforms()
+            if self.should_cache_trunk_features():
+                shared_datasets = self.get_trunk_feature_datasets(shared_datasets)
+            datasets = defaultdict(dict)
+            for transform_type, T in transforms.items():
+                logging.info("{} transform: {}".format(transform_type, T))
+                for split_name in self.split_manager.split_names:
+                    datasets[transform_type][split_name] = d_u.get_dataset_with_transform(shared_datasets[split_name], T)
         
-        self.split_manager.create_split_schemes(datasets)
+        with startup_profile.section("split creation"):
+            self.split_manager.create_split_schemes(datasets)
+
+    def get_shared_datasets(self, chosen_dataset, original_dataset_params):
+        already_constructed, shared_datasets = [], {}
+        for split_name in self.split_manager.split_names:
+            dataset_params = copy.deepcopy(original_dataset_params[split_name])
+            dataset_params["transform"] = None
+            if "root" not in dataset_params:
+                dataset_params["root"] = self.args.dataset_root
+            for dataset_class, params, dataset in already_constructed:
+                if dataset_class is chosen_dataset[split_name] and params == dataset_params:
+                    shared_datasets[split_name] = dataset
+                    break
+            else:
+                shared_datasets[split_name] = chosen_dataset[split_name](**dataset_params)
+                d_u.set_dataset_params(shared_datasets[split_name], dataset_params)
+                already_constructed.append((chosen_dataset[split_name], dataset_params, shared_datasets[split_name]))
+        return shared_datasets
         
+    # for caches that are shared by all experiments in the same root experiment folder
+    def get_shared_cache_folder(self, cache_name):
+        return os.path.join(os.path.dirname(os.path.normpath(self.experiment_folder)), cache_name)
+
+    def should_cache_trunk_features(self):
+        if not getattr(self.args, "cache_trunk_features", False):
+            return False
+        trunk_optimizer = self.args.optimizers.get("trunk_optimizer")
+        if trunk_optimizer is not None and c_f.first_val_of_dict(trunk_optimizer).get("lr", None) != 0:
+            logging.warning("cache_trunk_features is True, but the trunk_optimizer has a non-zero learning rate. Trunk features will not be cached.")
+            return False
+        return True
+
+    # The trunk is run once (with the eval transform) over each dataset, and the
+    # features are saved in a cache folder that is shared by all experiments in the root experiment folder.
+    def get_trunk_feature_datasets(self, shared_datasets):
+        self.trunk_for_cached_features = self.get_trunk_model(self.args.models["trunk"])
+        self.trunk_for_cached_features_hash = c_f.get_state_dict_hash(self.trunk_for_cached_features)
+        cache_folder = self.get_shared_cache_folder("trunk_feature_cache")
+        compute_kwargs = {"batch_size": self.tester_settings["batch_size"],
+                        "num_workers": self.tester_settings["dataloader_num_workers"],
+                        "collate_fn": self.get_collate_fn(),
+                        "device": self.device}
+        feature_datasets, already_computed = {}, {}
+        for split_name, dataset in shared_datasets.items():
+            if id(dataset) not in already_computed:
+                already_computed[id(dataset)] = trunk_feature_cache.get_trunk_feature_dataset(self.trunk_for_cached_features, 
+                                                                                            self.trunk_for_cached_features_hash,
+                                                                                            dataset, 
+                                                                                            self.transforms["eval"], 
+                                                                                            cache_folder, 
+                                                                                            self.split_manager, 
+                                                                                            **compute_kwargs)
+            feature_datasets[split_name] = already_computed[id(dataset)]
+        return feature_datasets
+
+    def should_cache_eval_tensors(self):
+        return getattr(self.args, "cache_eval_tensors", False) and self.trunk_for_cached_features is None
+
+    # The eval transform is deterministic, so each eval split is transformed once, and saved in a cache folder
+    # that is shared by all experiments in the root experiment folder. The tester then reads from the cached arrays.
+    def get_eval_tensor_datasets(self, dataset_dict):
+        if not self.should_cache_eval_tensors():
+            return dataset_dict
+        cache_folder = self.get_shared_cache_folder("eval_tensor_cache")
+        compute_kwargs = {"batch_size": self.tester_settings["batch_size"],
+                        "num_workers": self.tester_settings["dataloader_num_workers"],
+                        "collate_fn": self.get_collate_fn()}
+        output = {}
+        for split_name, dataset in dataset_dict.items():
+            if id(dataset) not in self.eval_tensor_datasets:
+                self.eval_tensor_datasets[id(dataset)] = (dataset, eval_tensor_cache.get_eval_tensor_dataset(dataset, cache_folder, self.split_manager, **compute_kwargs))
+            output[split_name] = self.eval_tensor_datasets[id(dataset)][1]
+        return output
+
     def get_transforms(self):
         try:
-            trunk = self.get_trunk_model(self.args.models["trunk"])
-            if isinstance(trunk, torch.nn.DataParallel):
-                trunk = trunk.module
-            model_transform_properties = {k:getattr(trunk, k) for k in ["mean", "std", "input_space", "input_range"]}
+            model_transform_properties = self.get_trunk_model_properties(self.args.models["trunk"])
         except (KeyError, AttributeError):
             model_transform_properties = {"mean": [0.485, 0.456, 0.406], "std": [0.229, 0.224, 0.225]}
         self.transforms = {"train": None, "eval": None}
@@ -230,11 +363,24 @@ class BaseAPIParser:
         logging.info("EMBEDDER MODEL %s"%model)
         return model
 
+    # Each trunk config is constructed (and its pretrained weights loaded) only once.
+    # get_trunk_model returns copies of this pristine model.
+    def get_pristine_trunk_model(self, model_type):
+        key = json.dumps(model_type, sort_keys=True, default=str)
+        if key not in self.pristine_trunk_models:
+            model = self.pytorch_getter.get("model", yaml_dict=copy.deepcopy(model_type))
+            base_model_output_size = c_f.get_last_linear(model).in_features
+            c_f.set_last_linear(model, pml_cf.Identity())
+            self.pristine_trunk_models[key] = (model, base_model_output_size)
+        return self.pristine_trunk_models[key]
+
     def get_trunk_model(self, model_type):
-        model = self.pytorch_getter.get("model", yaml_dict=model_type)
-        self.base_model_output_size = c_f.get_last_linear(model).in_features
-        c_f.set_last_linear(model, pml_cf.Identity())
-        return model
+        model, self.base_model_output_size = self.get_pristine_trunk_model(model_type)
+        return copy.deepcopy(model)
+
+    def get_trunk_model_properties(self, model_type):
+        model, _ = self.get_pristine_trunk_model(model_type)
+        return {k:getattr(model, k) for k in ["mean", "std", "input_space", "input_range"]}
 
     def get_mining_function(self, miner_type):
         if miner_type:
@@ -291,22 +437,30 @@ class BaseAPIParser:
                 "embedder": lambda model_type: self.get_embedder_model(model_type, input_size=self.base_model_output_size)}
 
     def set_model(self):
-        self.models = {}
-        for k, v in self.model_getter_dict().items():
-            self.models[k] = v(self.args.models[k])
+        with startup_profile.section("model construction"):
+            self.models = {}
+            for k, v in self.model_getter_dict().items():
+                self.models[k] = v(self.args.models[k])
+            if self.trunk_for_cached_features is not None:
+                self.models["trunk"] = architectures.misc_models.PrecomputedTrunk(copy.deepcopy(self.trunk_for_cached_features))
 
     def load_model_for_eval(self, model_name):
+        self.wait_for_saved_models()
         untrained_trunk = model_name in const.UNTRAINED_TRUNK_ALIASES
         untrained_trunk_and_embedder = model_name in const.UNTRAINED_TRUNK_AND_EMBEDDER_ALIASES
         trunk_model = self.get_trunk_model(self.args.models["trunk"])
         if untrained_trunk:
             embedder_model = pml_cf.Identity()
+        elif untrained_trunk_and_embedder and self.should_cache_untrained_evals():
+            with torch.random.fork_rng(devices=[]):
+                torch.manual_seed(untrained_eval_cache.UNTRAINED_EMBEDDER_SEED)
+                embedder_model = self.get_embedder_model(self.args.models["embedder"], self.base_model_output_size)
         else:
             embedder_model = self.get_embedder_model(self.args.models["embedder"], self.base_model_output_size)
             if not untrained_trunk_and_embedder: 
                 if model_name in const.TRAINED_ALIASES:
-                    _, model_name = pml_cf.latest_version(self.model_folder, best=True)
-                pml_cf.load_dict_of_models(
+                    _, model_name = self.latest_version(best=True)
+                tensor_store.load_dict_of_models(
                     {"trunk": trunk_model, "embedder": embedder_model},
                     model_name,
                     self.model_folder,
@@ -314,6 +468,10 @@ class BaseAPIParser:
                     log_if_successful = True,
                     assert_success = True
                 )
+        if self.trunk_for_cached_features is not None:
+            if not (untrained_trunk or untrained_trunk_and_embedder) and c_f.get_state_dict_hash(trunk_model) != self.trunk_for_cached_features_hash:
+                raise ValueError("The weights of trunk model {} are different from the trunk that was used to compute the cached features".format(model_name))
+            trunk_model = architectures.misc_models.PrecomputedTrunk(trunk_model)
         return torch.nn.DataParallel(trunk_model), torch.nn.DataParallel(embedder_model)
 
     def eval_assertions(self, dataset_dict):
@@ -321,7 +479,7 @@ class BaseAPIParser:
             assert v is self.split_manager.get_dataset("eval", k)
             assert d_u.get_underlying_dataset(v).transform is self.transforms["eval"]
 
-    def eval_model(self, epoch, model_name, load_model=False, skip_eval_if_already_done=True):
+    def eval_model(self, epoch, model_name, load_model=False, skip_eval_if_already_done=True, dataset_dict=None):
         logging.info("Launching evaluation for model %s"%model_name)
         if load_model:
             logging.info("Initializing/loading models for evaluation")
@@ -330,11 +488,78 @@ class BaseAPIParser:
             logging.info("Using self.models for evaluation")
             trunk_model, embedder_model = self.models["trunk"], self.models["embedder"]
         trunk_model, embedder_model = trunk_model.to(self.device), embedder_model.to(self.device)
-        dataset_dict = self.split_manager.get_dataset_dict("eval", inclusion_list=self.args.splits_to_eval)
-        self.eval_assertions(dataset_dict)
+        is_untrained = model_name in const.UNTRAINED_TRUNK_ALIASES + const.UNTRAINED_TRUNK_AND_EMBEDDER_ALIASES
+        use_untrained_eval_cache = is_untrained and load_model and dataset_dict is None and self.should_cache_untrained_evals()
+        if dataset_dict is None:
+            dataset_dict = self.split_manager.get_dataset_dict("eval", inclusion_list=self.args.splits_to_eval)
+            self.eval_assertions(dataset_dict)
+            if use_untrained_eval_cache:
+                return self.eval_untrained_model_with_cache(epoch, trunk_model, embedder_model, dataset_dict, skip_eval_if_already_done)
+            dataset_dict = self.get_eval_tensor_datasets(dataset_dict)
+        if self.should_stream_embeddings():
+            return self.eval_model_with_streamed_embeddings(epoch, model_name, trunk_model, embedder_model, dataset_dict, skip_eval_if_already_done)
         return self.hooks.run_tester_separately(self.tester, dataset_dict, epoch, trunk_model, embedder_model, 
                                         splits_to_eval=self.args.splits_to_eval, collate_fn=self.get_collate_fn(), skip_eval_if_already_done=skip_eval_if_already_done)
 
+    def should_stream_embeddings(self):
+        if not getattr(self.args, "stream_embeddings_to_disk", False):
+            return False
+        if self.tester_settings.get("pca"):
+            logging.warning("stream_embeddings_to_disk can't be used with PCA. Embeddings will be kept in memory.")
+            return False
+        return True
+
+    def get_streamed_embeddings_folder(self):
+        if self.args.evaluate and self.get_curr_meta_testing_method():
+            return os.path.join(self.experiment_folder, "meta_logs", "streamed_embeddings")
+        return os.path.join(os.path.dirname(self.model_folder), "streamed_embeddings")
+
+    # Each split's embeddings are written in chunks to a memory-mapped file, and the accuracies
+    # are computed from that file, so the embeddings don't need to fit in memory.
+    def eval_model_with_streamed_embeddings(self, epoch, model_name, trunk_model, embedder_model, dataset_dict, skip_eval_if_already_done):
+        splits_to_eval = self.args.splits_to_eval
+        if skip_eval_if_already_done:
+            splits_to_eval = self.hooks.get_splits_to_eval(self.tester, dataset_dict, epoch, splits_to_eval)
+            if len(splits_to_eval) == 0:
+                logging.info("Already evaluated")
+                return False
+        splits_to_eval, splits_to_compute_embeddings = self.tester.get_splits_to_compute_embeddings(dataset_dict, splits_to_eval)
+        folder = self.get_streamed_embeddings_folder()
+        embeddings_and_labels = {}
+        for split_name in splits_to_compute_embeddings:
+            dataset = dataset_dict[split_name]
+            name = "{}_{}_epoch{}_{}".format(self.hooks.base_record_group_name(self.tester), model_name, epoch, split_name)
+            key = streamed_embeddings.get_key(trunk_model, embedder_model, dataset, self.tester)
+            embeddings_and_labels[split_name] = streamed_embeddings.compute_embeddings(self.tester, trunk_model, embedder_model, dataset, folder, name, key, self.get_collate_fn())
+        streamed_embeddings.test_with_embeddings(self.tester, embeddings_and_labels, epoch, splits_to_eval)
+        return True
+
+    def should_cache_untrained_evals(self):
+        return getattr(self.args, "cache_untrained_evals", False)
+
+    # Untrained models are the same across split schemes, experiments, and Bayesian optimization trials,
+    # so their embeddings and accuracies are cached, and replayed through the end_of_testing_hook.
+    def eval_untrained_model_with_cache(self, epoch, trunk_model, embedder_model, dataset_dict, skip_eval_if_already_done):
+        splits_to_eval = self.args.splits_to_eval
+        if skip_eval_if_already_done:
+            splits_to_eval = self.hooks.get_splits_to_eval(self.tester, dataset_dict, epoch, splits_to_eval)
+            if len(splits_to_eval) == 0:
+                logging.info("Already evaluated")
+                return False
+        cache_folder = self.get_shared_cache_folder("untrained_eval_cache")
+        key = untrained_eval_cache.get_key(trunk_model, embedder_model, self.transforms["eval"], dataset_dict, splits_to_eval, self.tester, self.split_manager.labels_attr_name, self.args.tester)
+        cached = untrained_eval_cache.load(cache_folder, key)
+        if cached is None:
+            self.tester.test(self.get_eval_tensor_datasets(dataset_dict), epoch, trunk_model, embedder_model, splits_to_eval, self.get_collate_fn())
+            untrained_eval_cache.save(cache_folder, key, self.tester.embeddings_and_labels, self.tester.all_accuracies)
+        else:
+            self.tester.embeddings_and_labels, self.tester.all_accuracies = cached
+            for accuracies in self.tester.all_accuracies.values():
+                accuracies["epoch"] = epoch
+            self.tester.dim_reduced_embeddings = defaultdict(dict)
+            self.tester.end_of_testing_hook(self.tester)
+        return True
+
     def flush_tensorboard(self):
         for keeper in ["record_keeper", "meta_record_keeper"]:
             k = getattr(self, keeper, None)
@@ -343,6 +568,7 @@ class BaseAPIParser:
                 k.tensorboard_writer.close()
 
     def set_record_keeper(self):
+        import pytorch_metric_learning.utils.logging_presets as logging_presets
         is_new_experiment = self.beginning_of_training() and self.curr_split_count == 0
         self.record_keeper, _, _ = logging_presets.get_record_keeper(csv_folder = self.csv_folder, 
                                                                     tensorboard_folder = self.tensorboard_folder, 
@@ -353,6 +579,7 @@ class BaseAPIParser:
                                                                     save_lists = self.args.save_lists_in_db)
 
     def set_meta_record_keeper(self):
+        import pytorch_metric_learning.utils.logging_presets as logging_presets
         is_new_experiment = self.beginning_of_training()
         folders = {folder_type: s % (self.experiment_folder, "meta_logs") for folder_type, s in self.sub_experiment_dirs.items()}
         csv_folder, tensorboard_folder = folders["csvs"], folders["tensorboard"]
@@ -378,6 +605,7 @@ class BaseAPIParser:
                         self.meta_accuracies[split][trained_status][k][split_scheme_name] = accuracies[0][k]
 
     def record_meta_logs(self):
+        from scipy import stats as scipy_stats
         if len(self.meta_accuracies) > 0:
             for split in self.args.splits_to_eval:
                 group_name = self.get_eval_record_name_dict(const.META_SEPARATE_EMBEDDINGS)[split]
@@ -411,8 +639,89 @@ class BaseAPIParser:
             return tuple(q[0][k] for k in keys)
         return q[0][keys[0]]
 
+    # the same as HookContainer.load_latest_saved_models, but the latest epoch comes from the experiment manifest
     def maybe_load_latest_saved_models(self):
-        return self.hooks.load_latest_saved_models(self.trainer, self.model_folder, self.device, best=self.args.resume_training=="best")
+        self.wait_for_saved_models()
+        resume_epoch, model_suffix = self.latest_version(best=self.args.resume_training=="best")
+        if resume_epoch > 0:
+            for obj_dict in [getattr(self.trainer, x, {}) for x in self.hooks.saveable_trainer_objects]:
+                tensor_store.load_dict_of_models(obj_dict, model_suffix, self.model_folder, self.device, log_if_successful=True)
+        return resume_epoch + 1
+
+    def latest_version(self, best=False):
+        return experiment_manifest.latest_version(self.experiment_folder, self.model_folder, best=best)
+
+    # Every checkpoint that the hook container saves or deletes is written atomically, and recorded in the experiment manifest.
+    # With async_model_saving, the checkpoints are written by a background thread.
+    # With deduplicate_checkpoints, the checkpoints are saved through the tensor store.
+    # When the latest models are saved, every epoch other than the latest keep_latest_checkpoints is deleted,
+    # rather than only the epoch that the hook container passes as prev_suffix.
+    def wrap_save_models(self, hooks):
+        def save_models_and_record(trainer, model_folder, curr_suffix, prev_suffix=None):
+            if isinstance(curr_suffix, int):
+                prev_suffix = self.get_old_checkpoints(model_folder, curr_suffix)
+            state_dicts = {k: checkpoint_writer.get_state_dict(v) for x in hooks.saveable_trainer_objects for k, v in getattr(trainer, x, {}).items()}
+            self.write_checkpoint(state_dicts, model_folder, curr_suffix, prev_suffix)
+        hooks.save_models = save_models_and_record
+
+    # Writes the state dicts ({name: state dict}) and deletes the ones with prev_suffix, in the background
+    # if async_model_saving is set, and through the tensor store if deduplicate_checkpoints is set.
+    # Also used for the best models saved by the background evaluator.
+    def write_checkpoint(self, state_dicts, model_folder, curr_suffix, prev_suffix=None):
+        store = self.get_tensor_store()
+        kwargs = {"save_state_dict": store.save_state_dict, "delete_checkpoint": store.delete_checkpoint} if store is not None else {}
+        if getattr(self.args, "async_model_saving", False):
+            if self.checkpoint_writer is None:
+                self.checkpoint_writer = checkpoint_writer.CheckpointWriter(record_checkpoint=self.record_checkpoint, **kwargs)
+            self.checkpoint_writer.save_state_dicts(state_dicts, model_folder, curr_suffix, prev_suffix)
+        else:
+            checkpoint_writer.write_checkpoint(state_dicts, model_folder, curr_suffix, prev_suffix, **kwargs)
+            self.record_checkpoint(model_folder, curr_suffix, prev_suffix)
+
+    # The epochs of the latest checkpoints in the manifest, other than the latest keep_latest_checkpoints.
+    # curr_suffix is the epoch being saved, which is never included. The best checkpoints have their own suffixes.
+    def get_old_checkpoints(self, model_folder, curr_suffix=None):
+        checkpoints = experiment_manifest.get_model_folder_entry(self.experiment_folder, model_folder)["checkpoints"]
+        epochs = set(experiment_manifest.get_epochs(checkpoints, best=False))
+        if curr_suffix is not None:
+            epochs.add(curr_suffix)
+        num_to_keep = max(getattr(self.args, "keep_latest_checkpoints", 1), 1)
+        return [x for x in sorted(epochs)[:-num_to_keep] if x != curr_suffix]
+
+    # Checkpoints that were still being written when they became old are deleted at the end of training.
+    def delete_old_checkpoints(self):
+        old_checkpoints = self.get_old_checkpoints(self.model_folder)
+        if len(old_checkpoints) == 0:
+            return
+        keys = [k for x in self.hooks.saveable_trainer_objects for k in getattr(self.trainer, x, {}).keys()]
+        store = self.get_tensor_store()
+        delete_checkpoint = store.delete_checkpoint if store is not None else checkpoint_writer.delete_checkpoint
+        for suffix in old_checkpoints:
+            delete_checkpoint(self.model_folder, keys, suffix)
+        self.record_checkpoint(self.model_folder, None, old_checkpoints)
+
+    def get_tensor_store(self):
+        if self.tensor_store is None and getattr(self.args, "deduplicate_checkpoints", False):
+            self.tensor_store = tensor_store.TensorStore(os.path.join(self.experiment_folder, tensor_store.OBJECTS_FOLDER_NAME))
+        return self.tensor_store
+
+    def wait_for_saved_models(self):
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.flush()
+
+    # raise_error=False is used when training has already failed, so that its error isn't replaced
+    def close_checkpoint_writer(self, raise_error=True):
+        if self.checkpoint_writer is not None:
+            writer, self.checkpoint_writer = self.checkpoint_writer, None
+            try:
+                writer.close()
+            except Exception as e:
+                if raise_error:
+                    raise
+                logging.error("Could not save checkpoint: %s"%repr(e))
+
+    def record_checkpoint(self, model_folder, curr_suffix, prev_suffix=None):
+        experiment_manifest.record_checkpoint(self.experiment_folder, model_folder, curr_suffix, prev_suffix)
 
     def set_models_optimizers_losses(self):
         self.set_model()
@@ -422,6 +731,7 @@ class BaseAPIParser:
         self.set_optimizers()
         self.set_record_keeper()
         self.hooks = self.get_hook_container(self.args.hook_container)
+        self.wrap_save_models(self.hooks)
         self.tester = self.get_tester(self.args.tester)
         self.trainer = self.get_trainer(self.args.trainer)
         if self.is_training():
@@ -444,20 +754,68 @@ class BaseAPIParser:
         tester, tester_params = self.pytorch_getter.get("tester", yaml_dict=tester_type, return_uninitialized=True)
         other_args = {"data_device": self.device,
                     "data_and_label_getter": self.split_manager.data_and_label_getter,
-                    "end_of_testing_hook": self.hooks.end_of_testing_hook,
+                    "end_of_testing_hook": self.get_end_of_testing_hook(),
                     "accuracy_calculator": self.get_accuracy_calculator(tester_params["accuracy_calculator"])}
         tester_params = emag_utils.merge_two_dicts(tester_params, other_args)
         return tester(**tester_params)
 
+    def get_end_of_testing_hook(self):
+        hooks = self.hooks
+        def end_of_testing_hook(tester):
+            if self.should_save_embeddings():
+                self.save_embeddings(tester)
+            return hooks.end_of_testing_hook(tester)
+        return end_of_testing_hook
+
+    # The per-split-scheme embeddings are saved during the meta_SeparateEmbeddings evaluation,
+    # so that meta_ConcatenateEmbeddings can concatenate them instead of running every model again.
+    def should_save_embeddings(self):
+        return getattr(self.args, "save_embeddings_for_concatenation", False) and self.args.evaluate and self.get_curr_meta_testing_method() is None
+
+    # The size and modification time of the checkpoint files of an epoch, so that saved embeddings
+    # aren't reused after the checkpoint is overwritten, like by retraining. Untrained models have no files.
+    def get_checkpoint_identity(self, epoch):
+        identity = []
+        for suffix in ["best%d"%epoch, epoch]:
+            for k in ["trunk", "embedder"]:
+                model_path = pml_cf.modelpath_creator(self.model_folder, k, suffix)
+                if os.path.isfile(model_path):
+                    stat = os.stat(model_path)
+                    identity.append([os.path.basename(model_path), stat.st_size, stat.st_mtime_ns])
+        return identity
+
+    def get_embeddings_folder(self):
+        return os.path.join(os.path.dirname(self.model_folder), "saved_embeddings")
+
+    # With float16 or int8, and check_saved_embeddings_accuracy, the change in accuracy caused by
+    # the lower precision is logged, and saved in the header of each file.
+    def save_embeddings(self, tester):
+        epoch = c_f.first_val_of_dict(tester.all_accuracies)["epoch"]
+        dtype = getattr(self.args, "saved_embeddings_dtype", "float32")
+        check_accuracy = dtype != "float32" and getattr(self.args, "check_saved_embeddings_accuracy", False)
+        accuracy_deltas = embedding_store.get_accuracy_deltas(tester, dtype) if check_accuracy else {}
+        checkpoint_identity = self.get_checkpoint_identity(epoch)
+        for split_name, (embeddings, labels) in tester.embeddings_and_labels.items():
+            extra_header = {"checkpoint": checkpoint_identity}
+            if split_name in accuracy_deltas:
+                extra_header["accuracy_deltas"] = accuracy_deltas[split_name]
+            embedding_store.save_embeddings(self.get_embeddings_folder(), embedding_store.get_filename(tester, epoch, split_name), embeddings, labels, dtype, extra_header)
+
     def get_end_of_epoch_hook(self):
         logging.info("Creating end_of_epoch_hook kwargs")
         dataset_dict = self.split_manager.get_dataset_dict("eval", inclusion_list=self.args.splits_to_eval)
-        helper_hook = self.hooks.end_of_epoch_hook(tester=self.tester,
-                                                    dataset_dict=dataset_dict,
-                                                    model_folder=self.model_folder,
-                                                    test_interval=self.args.save_interval,
-                                                    patience=self.args.patience,
-                                                    test_collate_fn=self.get_collate_fn())
+        hook_kwargs = {"tester": self.tester,
+                        "dataset_dict": self.get_eval_tensor_datasets(dataset_dict),
+                        "model_folder": self.model_folder,
+                        "test_interval": self.args.save_interval,
+                        "patience": self.args.patience,
+                        "test_collate_fn": self.get_collate_fn()}
+        self.background_evaluator = None
+        if self.should_eval_in_background():
+            self.background_evaluator = background_eval.BackgroundEvaluator(self.hooks, write_checkpoint=self.write_checkpoint, **hook_kwargs)
+            helper_hook = self.background_evaluator
+        else:
+            helper_hook = self.hooks.end_of_epoch_hook(**hook_kwargs)
         def end_of_epoch_hook(trainer):
             torch.cuda.empty_cache()
             self.eval_assertions(dataset_dict)
@@ -465,6 +823,15 @@ class BaseAPIParser:
 
         return end_of_epoch_hook
 
+    # The evaluation process is forked, which is only safe when the models are on the CPU
+    def should_eval_in_background(self):
+        if not getattr(self.args, "background_eval", False):
+            return False
+        if self.device.type != "cpu":
+            logging.warning("background_eval is only supported on CPU. Evaluation will block training.")
+            return False
+        return True
+
     def get_trainer(self, trainer_type):
         trainer, trainer_params = self.pytorch_getter.get("trainer", yaml_dict=trainer_type, return_uninitialized=True)
         other_args = {
@@ -498,7 +865,7 @@ class BaseAPIParser:
             c_f.move_optimizer_to_gpu(v, self.device)
 
     def should_train(self, num_epochs, split_scheme_name):
-        best_epoch, _ = pml_cf.latest_version(self.model_folder, best=True)
+        best_epoch, _ = self.latest_version(best=True)
         return self.hooks.patience_remaining(self.epoch, best_epoch, self.args.patience) and self.latest_sub_experiment_epochs[split_scheme_name] < num_epochs
 
     def training_assertions(self, trainer):
@@ -512,27 +879,148 @@ class BaseAPIParser:
         if untrained_trunk_and_embedder:
             eval_dict[const.UNTRAINED_TRUNK_AND_EMBEDDER] = (const.UNTRAINED_TRUNK_AND_EMBEDDER_INT, randomize_embedder)
         if best:
-            best_epoch, _ = pml_cf.latest_version(self.model_folder, best=True)
+            best_epoch, _ = self.latest_version(best=True)
             eval_dict["best"] = (best_epoch, True)
         return eval_dict
 
     def train(self, num_epochs):
         if self.args.check_untrained_accuracy:
-            eval_dict = self.get_eval_dict(False, True, True, randomize_embedder = self.epoch!=1)
-            for name, (epoch, load_model) in eval_dict.items():
-                self.eval_model(epoch, name, load_model=load_model, skip_eval_if_already_done=self.args.skip_eval_if_already_done)
-                self.record_keeper.save_records()
+            # the cached untrained evaluations use a freshly initialized embedder
+            randomize_embedder = self.epoch != 1 or self.should_cache_untrained_evals()
+            eval_dict = self.get_eval_dict(False, True, True, randomize_embedder=randomize_embedder)
+            self.eval_models(eval_dict, skip_eval_if_already_done=self.args.skip_eval_if_already_done)
         self.training_assertions(self.trainer)        
-        self.trainer.train(self.epoch, num_epochs)
+        training_failed = True
+        try:
+            self.trainer.train(self.epoch, num_epochs)
+            if self.background_evaluator is not None:
+                self.background_evaluator.finish(self.trainer)
+            training_failed = False
+        finally:
+            if getattr(self, "background_evaluator", None) is not None:
+                self.background_evaluator.shutdown()
+            # so that checkpoints that were already queued are written, even if training fails
+            self.close_checkpoint_writer(raise_error=not training_failed)
+        self.delete_old_checkpoints()
+        if self.get_tensor_store() is not None:
+            self.tensor_store.collect_garbage()
 
     def eval(self):
         untrained = self.args.check_untrained_accuracy
         eval_dict = self.get_eval_dict(True, untrained, untrained, randomize_embedder=True)
+        self.eval_models(eval_dict, skip_eval_if_already_done=self.args.skip_eval_if_already_done)
+
+    def eval_models(self, eval_dict, skip_eval_if_already_done):
+        if self.should_eval_in_single_pass():
+            eval_dict = self.eval_models_in_single_pass(eval_dict, skip_eval_if_already_done)
         for name, (epoch, load_model) in eval_dict.items():
-            self.eval_model(epoch, name, load_model=load_model, skip_eval_if_already_done=self.args.skip_eval_if_already_done)
+            self.eval_model(epoch, name, load_model=load_model, skip_eval_if_already_done=skip_eval_if_already_done)
             self.record_keeper.save_records()
 
+    def should_eval_in_single_pass(self):
+        return getattr(self.args, "single_pass_eval", False)
+
+    # Loads and transforms each eval batch once, and feeds it to all models in eval_dict.
+    # The embeddings of each model are then passed through the tester, so that the accuracies
+    # are computed and recorded exactly as they are in eval_model.
+    # Returns the models that should still be evaluated by eval_model.
+    def eval_models_in_single_pass(self, eval_dict, skip_eval_if_already_done):
+        dataset_dict = self.split_manager.get_dataset_dict("eval", inclusion_list=self.args.splits_to_eval)
+        self.eval_assertions(dataset_dict)
+        remaining, to_eval = {}, {}
+        for name, (epoch, load_model) in eval_dict.items():
+            is_untrained = name in const.UNTRAINED_TRUNK_ALIASES + const.UNTRAINED_TRUNK_AND_EMBEDDER_ALIASES
+            if is_untrained and load_model and self.should_cache_untrained_evals():
+                remaining[name] = (epoch, load_model)
+                continue
+            splits_to_eval = self.args.splits_to_eval
+            if skip_eval_if_already_done:
+                splits_to_eval = self.hooks.get_splits_to_eval(self.tester, dataset_dict, epoch, splits_to_eval)
+                if len(splits_to_eval) == 0:
+                    logging.info("Already evaluated model %s"%name)
+                    continue
+            to_eval[name] = (epoch, load_model, splits_to_eval)
+        if len(to_eval) < 2:
+            remaining.update({k: v[:2] for k, v in to_eval.items()})
+            return remaining
+
+        list_of_models, splits_per_model = [], []
+        for name, (epoch, load_model, splits_to_eval) in to_eval.items():
+            logging.info("Initializing/loading model %s for single pass evaluation"%name)
+            trunk_model, embedder_model = self.load_model_for_eval(model_name=name) if load_model else (self.models["trunk"], self.models["embedder"])
+            trunk_model, embedder_model = trunk_model.to(self.device), embedder_model.to(self.device)
+            trunk_model.eval()
+            embedder_model.eval()
+            list_of_models.append((trunk_model, embedder_model))
+            splits_per_model.append(self.tester.get_splits_to_compute_embeddings(dataset_dict, splits_to_eval)[1])
+
+        embeddings_and_labels = [{} for _ in list_of_models]
+        eval_datasets = self.get_eval_tensor_datasets(dataset_dict)
+        for split_name in dataset_dict.keys():
+            model_idx = [i for i, splits in enumerate(splits_per_model) if split_name in splits]
+            if len(model_idx) == 0:
+                continue
+            all_embeddings, labels = multi_model_eval.compute_embeddings_for_models(eval_datasets[split_name], 
+                                                                                    [list_of_models[i] for i in model_idx], 
+                                                                                    use_trunk_output=self.tester.use_trunk_output, 
+                                                                                    batch_size=self.tester.batch_size, 
+                                                                                    num_workers=self.tester.dataloader_num_workers, 
+                                                                                    collate_fn=self.get_collate_fn(), 
+                                                                                    data_and_label_getter=self.split_manager.data_and_label_getter, 
+                                                                                    device=self.tester.data_device)
+            for i, embeddings in zip(model_idx, all_embeddings):
+                embeddings_and_labels[i][split_name] = embedding_store.ArrayDataset(embeddings, labels, self.split_manager.data_and_label_getter_keys)
+        del list_of_models
+
+        # the precomputed embeddings go through identity models, so the tester's normalization,
+        # accuracy calculation and end_of_testing_hook are unchanged
+        for (name, (epoch, _, splits_to_eval)), curr_dataset_dict in zip(to_eval.items(), embeddings_and_labels):
+            logging.info("Computing accuracies for model %s"%name)
+            self.tester.test(curr_dataset_dict, epoch, pml_cf.Identity(), pml_cf.Identity(), splits_to_eval)
+            self.record_keeper.save_records()
+        return remaining
+
+    def get_epoch_of_model_name(self, model_name):
+        if model_name in const.UNTRAINED_TRUNK_ALIASES:
+            return const.UNTRAINED_TRUNK_INT
+        if model_name in const.UNTRAINED_TRUNK_AND_EMBEDDER_ALIASES:
+            return const.UNTRAINED_TRUNK_AND_EMBEDDER_INT
+        best_epoch, _ = self.latest_version(best=True)
+        return best_epoch
+
+    # Returns a dataset_dict of concatenated embeddings, if every split scheme's embeddings were saved.
+    # Each split scheme's embeddings are normalized like the operation_before_concat in meta_ConcatenateEmbeddings.
+    # PCA can't be undone, so the saved embeddings can't be used if PCA was applied.
+    def get_saved_concatenated_embeddings(self, model_name):
+        if self.tester_settings.get("pca"):
+            return None
+        normalize_before_concat = self.tester_settings["normalize_embeddings"] or self.tester_settings["use_trunk_output"]
+        saved = defaultdict(list)
+        for split_scheme_name in self.split_manager.split_scheme_names:
+            self.split_manager.set_curr_split_scheme(split_scheme_name)
+            self.set_curr_folders()
+            epoch = self.get_epoch_of_model_name(model_name)
+            expected_header = {"checkpoint": self.get_checkpoint_identity(epoch)}
+            for split_name in self.args.splits_to_eval:
+                x = embedding_store.load_embeddings(self.get_embeddings_folder(), embedding_store.get_filename(self.tester, epoch, split_name), expected_header)
+                if x is None:
+                    return None
+                saved[split_name].append(x)
+        dataset_dict = {}
+        for split_name, embeddings_and_labels in saved.items():
+            all_embeddings, all_labels = zip(*embeddings_and_labels)
+            if not all(np.array_equal(all_labels[0], x) for x in all_labels[1:]):
+                return None
+            if normalize_before_concat:
+                all_embeddings = [embedding_store.l2_normalize(x) for x in all_embeddings]
+            dataset_dict[split_name] = embedding_store.ArrayDataset(np.concatenate(all_embeddings, axis=1).astype(np.float32), all_labels[0], self.split_manager.data_and_label_getter_keys)
+        logging.info("Using saved embeddings of each split scheme for {} {}".format(const.META_CONCATENATE_EMBEDDINGS, model_name))
+        return dataset_dict
+
     def meta_ConcatenateEmbeddings(self, model_name): 
+        self.meta_dataset_dict = self.get_saved_concatenated_embeddings(model_name)
+        if self.meta_dataset_dict is not None:
+            return torch.nn.DataParallel(pml_cf.Identity()), torch.nn.DataParallel(pml_cf.Identity())
         list_of_trunks, list_of_embedders = [], []
         for split_scheme_name in self.split_manager.split_scheme_names:
             self.split_manager.set_curr_split_scheme(split_scheme_name)
@@ -548,7 +1036,8 @@ class BaseAPIParser:
         trunk_operation_before_concat = normalize_embeddings_func if self.tester_settings["use_trunk_output"] else None
 
         trunk = torch.nn.DataParallel(architectures.misc_models.ListOfModels(list_of_trunks, operation_before_concat=trunk_operation_before_concat))
-        embedder = torch.nn.DataParallel(architectures.misc_models.ListOfModels(list_of_embedders, embedder_input_sizes, embedder_operation_before_concat))
+        embedder = torch.nn.DataParallel(architectures.misc_models.ListOfModels(list_of_embedders, embedder_input_sizes, embedder_operation_before_concat, 
+                                                                                stack_identical_mlps=getattr(self.args, "stack_identical_mlps", False)))
         return trunk, embedder
 
     def meta_eval(self):
@@ -567,8 +1056,9 @@ class BaseAPIParser:
         group_names = [self.get_eval_record_name_dict(self.curr_meta_testing_method)[split_name] for split_name in self.args.splits_to_eval]
 
         for name in models_to_eval:
+            self.meta_dataset_dict = None
             self.models["trunk"], self.models["embedder"] = meta_model_getter(name)
-            did_not_skip = self.eval_model(name, name, load_model=False, skip_eval_if_already_done=self.args.skip_meta_eval_if_already_done)
+            did_not_skip = self.eval_model(name, name, load_model=False, skip_eval_if_already_done=self.args.skip_meta_eval_if_already_done, dataset_dict=self.meta_dataset_dict)
             if did_not_skip:
                 for group_name in group_names:
                     len_of_existing_records = c_f.try_getting_db_count(self.meta_record_keeper, group_name) + 1
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import logging
 
 
 class LayerExtractor(nn.Module):
@@ -36,15 +37,50 @@ class LayerExtractor(nn.Module):
 
 
 class ListOfModels(nn.Module):
-    def __init__(self, list_of_models, input_sizes=None, operation_before_concat=None):
+    # If stack_identical_mlps is True, identical MLPs are run as one batched computation.
+    # This is faster, but the outputs can differ from the per-model loop by floating point rounding.
+    # On the first forward pass, the batched outputs are compared with the loop's outputs,
+    # and if they aren't close, the loop is used from then on.
+    def __init__(self, list_of_models, input_sizes=None, operation_before_concat=None, stack_identical_mlps=False):
         super().__init__()
         self.list_of_models = nn.ModuleList(list_of_models)
         self.input_sizes = input_sizes
         self.operation_before_concat = (lambda x: x) if not operation_before_concat else operation_before_concat
         for k in ["mean", "std", "input_space", "input_range"]:
             setattr(self, k, getattr(list_of_models[0], k, None))
+        self.is_stackable = stack_identical_mlps and self.models_are_stackable()
+        self.stacked_forward_is_checked = False
+
+    # True if the models are MLPs with the same layers, and the same input size,
+    # so that they can be run as one batched matrix multiplication per layer.
+    def models_are_stackable(self):
+        if len(self.list_of_models) < 2 or not all(isinstance(m, MLP) for m in self.list_of_models):
+            return False
+        if self.input_sizes is not None and any(y != self.input_sizes[0] for y in self.input_sizes):
+            return False
+        def structure(m):
+            return [(type(layer), getattr(layer, "weight", torch.empty(0)).shape, getattr(layer, "bias", None) is not None) for layer in m.net]
+        first_structure = structure(self.list_of_models[0])
+        if any(layer_type not in [nn.Linear, nn.ReLU] for layer_type, _, _ in first_structure):
+            return False
+        return all(structure(m) == first_structure for m in self.list_of_models[1:])
 
     def forward(self, x):
+        if self.is_stackable and not self.stacked_forward_is_checked:
+            self.check_stacked_forward(x)
+        if self.is_stackable:
+            return self.stacked_forward(x)
+        return self.loop_forward(x)
+
+    def check_stacked_forward(self, x):
+        with torch.no_grad():
+            stacked_output, loop_output = self.stacked_forward(x), self.loop_forward(x)
+        if not torch.allclose(stacked_output, loop_output, rtol=1e-4, atol=1e-5):
+            logging.warning("The outputs of the stacked MLPs don't match the outputs of the individual MLPs. The MLPs will be run one at a time.")
+            self.is_stackable = False
+        self.stacked_forward_is_checked = True
+
+    def loop_forward(self, x):
         outputs = []
         if self.input_sizes is None:
             for m in self.list_of_models:
@@ -59,6 +95,46 @@ class ListOfModels(nn.Module):
                 s += y
         return torch.cat(outputs, dim=-1)
 
+    # The weights are stacked on every forward pass, so gradients still flow to each model's parameters.
+    def stacked_forward(self, x):
+        num_models = len(self.list_of_models)
+        if self.input_sizes is None:
+            x = x.unsqueeze(0).expand(num_models, -1, -1)
+        else:
+            y = int(self.input_sizes[0])
+            x = x[:, :num_models*y].reshape(x.size(0), num_models, y).transpose(0, 1)
+        for i, layer in enumerate(self.list_of_models[0].net):
+            if isinstance(layer, nn.ReLU):
+                x = torch.relu(x)
+                continue
+            layers = [m.net[i] for m in self.list_of_models]
+            weight = torch.stack([L.weight for L in layers]).transpose(1, 2)
+            if layer.bias is None:
+                x = torch.bmm(x, weight)
+            else:
+                x = torch.baddbmm(torch.stack([L.bias for L in layers]).unsqueeze(1), x, weight)
+        return torch.cat([self.operation_before_concat(z) for z in x], dim=-1)
+
+
+class PrecomputedTrunk(nn.Module):
+    # The inputs are trunk outputs that were computed in advance, so forward is the identity.
+    # The trunk is not registered as a submodule, so it has no trainable parameters and stays on the cpu,
+    # but it is what gets saved and loaded.
+    def __init__(self, trunk):
+        super().__init__()
+        self.__dict__["trunk"] = trunk
+        for k in ["mean", "std", "input_space", "input_range"]:
+            setattr(self, k, getattr(trunk, k, None))
+
+    def forward(self, x):
+        return x
+
+    def state_dict(self, *args, **kwargs):
+        return self.trunk.state_dict(*args, **kwargs)
+
+    def load_state_dict(self, *args, **kwargs):
+        return self.trunk.load_state_dict(*args, **kwargs)
+
 
 class MLP(nn.Module):
     # layer_sizes[0] is the dimension of the input
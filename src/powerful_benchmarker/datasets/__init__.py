@@ -1,5 +1,7 @@
+from .base_dataset import BaseDataset
 from .cars196 import Cars196
 from .celeb_a import CelebA
 from .cub200 import CUB200
 from .stanford_online_products import StanfordOnlineProducts
-from .logos_dataset import Logos
\ No newline at end of file
+from .logos_dataset import Logos
+from .packed_shards import PackedShards
\ No newline at end of file
@@ -0,0 +1,55 @@
+#! /usr/bin/env python3
+
+from PIL import Image
+from torch.utils.data import Dataset
+import numpy as np
+import os
+import logging
+from ..utils.image_cache import ResizedImageCache
+from ..utils import file_manifest
+
+class BaseDataset(Dataset):
+    image_cache = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        img = self.get_image(idx)
+        label = self.labels[idx]
+        if self.transform is not None:
+            img = self.transform(img)
+        output_dict = {"data": img, "label": label}
+        return output_dict
+
+    def get_image(self, idx):
+        if self.image_cache is not None:
+            return self.image_cache[idx]
+        return self.load_image(idx)
+
+    def load_image(self, idx):
+        return Image.open(self.img_paths[idx]).convert("RGB")
+
+    def get_image_ids(self, folder):
+        return [os.path.relpath(x, folder) for x in self.img_paths]
+
+    # scan_func returns (img_paths, labels, dict of extra items to save in the manifest)
+    def load_file_manifest(self, folder, scan_func):
+        manifest = file_manifest.load_manifest(folder)
+        if manifest is None:
+            img_paths, labels, kwargs = scan_func()
+            manifest = file_manifest.create_manifest(folder, img_paths, labels, **kwargs)
+        self.img_paths = [os.path.join(folder, x) for x in manifest["img_paths"]]
+        self.labels = np.array(manifest["labels"])
+        return manifest
+
+    # image_cache_size is the length of the shorter side of each cached image,
+    # and should match the first Resize of the transforms.
+    # The cache is placed next to folder, so that it isn't found by datasets that scan folder for images.
+    def maybe_set_image_cache(self, image_cache_size, folder, cache_folder=None):
+        if image_cache_size is None:
+            return
+        if cache_folder is None:
+            cache_folder = "%s_image_cache"%os.path.normpath(folder)
+        logging.info("Using image cache in %s"%cache_folder)
+        self.image_cache = ResizedImageCache(cache_folder, image_cache_size, self.get_image_ids(folder), self.load_image)
@@ -1,27 +1,15 @@
 #! /usr/bin/env python3
 
 import numpy as np
-from PIL import Image
-from torch.utils.data import Dataset
 import os
+from .base_dataset import BaseDataset
 
-class CelebA(Dataset):
-    def __init__(self, dataset_root, transform=None):
+class CelebA(BaseDataset):
+    def __init__(self, dataset_root, transform=None, image_cache_size=None):
         self.dataset_folder = os.path.join(dataset_root, "celeb_a")
         self.load_labels()
         self.transform = transform
-
-    def __len__(self):
-        return len(self.labels)
-
-    def __getitem__(self, idx):
-        path = self.img_paths[idx]
-        img = Image.open(path).convert("RGB")
-        label = self.labels[idx]
-        if self.transform is not None:
-            img = self.transform(img)
-        output_dict = {"data": img, "label": label}
-        return output_dict
+        self.maybe_set_image_cache(image_cache_size, self.dataset_folder)
 
     def load_labels(self):
         from pandas import read_csv
@@ -1,7 +1,5 @@
-from torch.utils.data import Dataset
 import os
-from PIL import Image
-import numpy as np
+from .base_dataset import BaseDataset
 
 
 def get_filepaths(directory):
@@ -26,34 +24,28 @@ def get_filepaths(directory):
     return file_paths
 
 
-class Logos(Dataset):
-    def __init__(self, dataset_root, transform=None):
+class Logos(BaseDataset):
+    def __init__(self, dataset_root, transform=None, image_cache_size=None):
         self.transform = transform
         self.path_to_logo_img_files = os.path.join(dataset_root, "clients_logos")
+        manifest = self.load_file_manifest(self.path_to_logo_img_files, self.scan_logo_img_files)
+        self.label_to_index = manifest["label_to_index"]
+        self.logo_dataset = list(zip(self.img_paths, self.labels.tolist()))
+        self.maybe_set_image_cache(image_cache_size, self.path_to_logo_img_files)
+
+    def scan_logo_img_files(self):
         files = get_filepaths(self.path_to_logo_img_files)
-        self.logo_dataset = []
-        self.labels = []
+        img_paths = []
+        labels = []
         index = 0
-        self.label_to_index = {}
+        label_to_index = {}
         for f in files:
             i1 = f.split("/")[-1]
             i1 = i1.split(".")[0]
             brand = i1.split("_")[0]
-            if brand not in self.label_to_index.keys():
-                self.label_to_index[brand] = index
+            if brand not in label_to_index.keys():
+                label_to_index[brand] = index
                 index += 1
-            self.logo_dataset.append((f, self.label_to_index[brand]))
-            self.labels.append(self.label_to_index[brand])
-
-        self.labels = np.asarray(self.labels)
-
-    def __len__(self):
-        return len(self.logo_dataset)
-
-    def __getitem__(self, idx):
-        img_path, label = self.logo_dataset[idx]
-        img = Image.open(img_path).convert("RGB")
-        if self.transform is not None:
-            img = self.transform(img)
-        output_dict = {"data": img, "label": label}
-        return output_dict
+            img_paths.append(f)
+            labels.append(label_to_index[brand])
+        return img_paths, labels, {"label_to_index": label_to_index}
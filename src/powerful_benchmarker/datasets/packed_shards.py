@@ -0,0 +1,99 @@
+#! /usr/bin/env python3
+
+import numpy as np
+from PIL import Image
+import io
+import os
+import logging
+import tqdm
+from ..utils import common_functions as c_f
+from .base_dataset import BaseDataset
+
+INDEX_FILENAME = "index.npz"
+
+
+def get_shard_filename(shard_idx):
+    return "shard_%05d.bin"%shard_idx
+
+
+def pack_dataset(dataset, output_folder, max_shard_bytes=2**30):
+    """
+    Copies the encoded bytes of every image in dataset.img_paths into a few large
+    shard files, and writes an index of (shard, offset, length) and labels.
+    """
+    if not hasattr(dataset, "img_paths"):
+        raise ValueError("pack_dataset requires a dataset with an img_paths attribute")
+    c_f.makedir_if_not_there(output_folder)
+    num_images = len(dataset.img_paths)
+    shard_ids = np.zeros(num_images, dtype=np.int32)
+    offsets = np.zeros(num_images, dtype=np.int64)
+    lengths = np.zeros(num_images, dtype=np.int64)
+    shard_idx, shard_bytes = 0, 0
+    f = open(os.path.join(output_folder, get_shard_filename(shard_idx)), "wb")
+    try:
+        for i, path in enumerate(tqdm.tqdm(dataset.img_paths)):
+            with open(path, "rb") as img_file:
+                encoded = img_file.read()
+            if shard_bytes > 0 and shard_bytes + len(encoded) > max_shard_bytes:
+                f.close()
+                shard_idx, shard_bytes = shard_idx + 1, 0
+                f = open(os.path.join(output_folder, get_shard_filename(shard_idx)), "wb")
+            f.write(encoded)
+            shard_ids[i], offsets[i], lengths[i] = shard_idx, shard_bytes, len(encoded)
+            shard_bytes += len(encoded)
+    finally:
+        f.close()
+    image_ids = dataset.get_image_ids(dataset.dataset_folder) if hasattr(dataset, "dataset_folder") else dataset.img_paths
+    tmp_index_path = os.path.join(output_folder, "%s.tmp.npz"%INDEX_FILENAME)
+    np.savez(tmp_index_path, shard_ids=shard_ids, offsets=offsets, lengths=lengths,
+            labels=np.asarray(dataset.labels), image_ids=np.array(image_ids), num_shards=shard_idx+1)
+    os.replace(tmp_index_path, os.path.join(output_folder, INDEX_FILENAME))
+    logging.info("Packed %d images into %d shards in %s"%(num_images, shard_idx+1, output_folder))
+
+
+class PackedShards(BaseDataset):
+    """
+    Reads a dataset written by pack_dataset. Each image is read with a single
+    pread from an already-open shard file, so there is no per-image open or stat.
+    """
+    def __init__(self, root, name, transform=None, image_cache_size=None):
+        self.dataset_folder = os.path.join(root, "packed_shards", name)
+        index = np.load(os.path.join(self.dataset_folder, INDEX_FILENAME))
+        self.shard_ids, self.offsets, self.lengths = index["shard_ids"], index["offsets"], index["lengths"]
+        self.labels = index["labels"]
+        self.image_ids = list(index["image_ids"])
+        self.shard_paths = [os.path.join(self.dataset_folder, get_shard_filename(i)) for i in range(int(index["num_shards"]))]
+        self.transform = transform
+        self.file_descriptors, self.pid = {}, None
+        self.maybe_set_image_cache(image_cache_size, self.dataset_folder)
+
+    def get_file_descriptor(self, shard_idx):
+        # file descriptors are not shared with forked dataloader workers
+        if self.pid != os.getpid():
+            self.file_descriptors, self.pid = {}, os.getpid()
+        if shard_idx not in self.file_descriptors:
+            self.file_descriptors[shard_idx] = os.open(self.shard_paths[shard_idx], os.O_RDONLY)
+        return self.file_descriptors[shard_idx]
+
+    def load_image(self, idx):
+        fd = self.get_file_descriptor(int(self.shard_ids[idx]))
+        encoded = os.pread(fd, int(self.lengths[idx]), int(self.offsets[idx]))
+        return Image.open(io.BytesIO(encoded)).convert("RGB")
+
+    def get_image_ids(self, folder):
+        return self.image_ids
+
+    def close(self):
+        # descriptors inherited by a forked process are left to the process that opened them
+        if getattr(self, "pid", None) == os.getpid():
+            for fd in self.file_descriptors.values():
+                os.close(fd)
+        self.file_descriptors = {}
+
+    def __del__(self):
+        self.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["file_descriptors"], state["pid"] = {}, None
+        return state
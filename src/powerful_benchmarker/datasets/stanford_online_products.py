@@ -1,19 +1,17 @@
 #! /usr/bin/env python3
 
 import numpy as np
-from PIL import Image
-from torch.utils.data import Dataset
 from torchvision.datasets.utils import download_url
 import os
-import zipfile
-from ..utils import common_functions as c_f
+from ..utils import archive_utils
+from .base_dataset import BaseDataset
 
-class StanfordOnlineProducts(Dataset):
+class StanfordOnlineProducts(BaseDataset):
     url = 'ftp://cs.stanford.edu/cs/cvgl/Stanford_Online_Products.zip'
     filename = 'Stanford_Online_Products.zip'
     md5 = '7f73d41a2f44250d4779881525aea32e'
 
-    def __init__(self, root, transform=None, download=False):
+    def __init__(self, root, transform=None, download=False, image_cache_size=None):
         self.root = root
         if download:
             self.download_dataset()
@@ -22,18 +20,7 @@ class StanfordOnlineProducts(Dataset):
         self.transform = transform
         assert len(np.unique(self.labels)) == 22634
         assert self.__len__() == 120053
-
-    def __len__(self):
-        return len(self.labels)
-
-    def __getitem__(self, idx):
-        path = self.img_paths[idx]
-        img = Image.open(path).convert("RGB")
-        label = self.labels[idx]
-        if self.transform is not None:
-            img = self.transform(img)
-        output_dict = {"data": img, "label": label}
-        return output_dict
+        self.maybe_set_image_cache(image_cache_size, self.dataset_folder)
 
     def load_labels(self):
         from pandas import read_csv
@@ -49,6 +36,7 @@ class StanfordOnlineProducts(Dataset):
         self.labels = np.array(self.labels)
 
     def download_dataset(self):
-        download_url(self.url, self.root, filename=self.filename, md5=self.md5)
-        with zipfile.ZipFile(os.path.join(self.root, self.filename), 'r') as zip_ref:
-            zip_ref.extractall(self.root, members = c_f.extract_progress(zip_ref))
\ No newline at end of file
+        archive_path = os.path.join(self.root, self.filename)
+        if not os.path.isfile(archive_path):
+            download_url(self.url, self.root, filename=self.filename)
+        archive_utils.install_archive(archive_path, self.root, md5=self.md5)
\ No newline at end of file
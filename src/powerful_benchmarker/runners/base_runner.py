@@ -1,12 +1,16 @@
 #! /usr/bin/env python3
 import logging
 logging.info("Importing packages in base_runner")
-from easy_module_attribute_getter import YamlReader, PytorchGetter
-from ..utils import common_functions as c_f
-import argparse
-import glob
-import os
-from collections import defaultdict
+from ..utils import startup_profile
+with startup_profile.section("imports"):
+    from easy_module_attribute_getter import YamlReader, PytorchGetter
+    from ..utils import common_functions as c_f
+    from ..utils.lazy_imports import LazyModule
+    import argparse
+    import glob
+    import inspect
+    import os
+    from collections import defaultdict
 logging.info("Done importing packages in base_runner")
 
 
@@ -36,21 +40,38 @@ class BaseRunner:
         self.pytorch_getter.register(module_type, module)
 
     def init_pytorch_getter(self):
-        from pytorch_metric_learning import trainers, losses, miners, regularizers, samplers, testers, utils
-        from .. import architectures, datasets, api_parsers, split_managers
-        self.pytorch_getter = PytorchGetter(use_pretrainedmodels_package=True)
-        self.pytorch_getter.register('model', architectures.misc_models)
-        self.pytorch_getter.register('loss', losses)
-        self.pytorch_getter.register('miner', miners)
-        self.pytorch_getter.register('regularizer', regularizers)
-        self.pytorch_getter.register('sampler', samplers)
-        self.pytorch_getter.register('trainer', trainers)
-        self.pytorch_getter.register('tester', testers)
-        self.pytorch_getter.register('dataset', datasets)
-        self.pytorch_getter.register('api_parser', api_parsers)
-        self.pytorch_getter.register('accuracy_calculator', utils.accuracy_calculator.AccuracyCalculator)
-        self.pytorch_getter.register('split_manager', split_managers)
-        self.pytorch_getter.register('hook_container', utils.logging_presets.HookContainer)
+        # Modules are imported the first time something is looked up in them,
+        # so that a run doesn't import the packages that its config doesn't use.
+        with startup_profile.section("getter registration"):
+            pml = lambda name, **kwargs: LazyModule("pytorch_metric_learning.%s"%name, **kwargs)
+            benchmarker = lambda name, **kwargs: LazyModule("..%s"%name, package=__package__, **kwargs)
+            self.pytorch_getter = PytorchGetter(use_pretrainedmodels_package=False)
+            self.pytorch_getter.register('model', LazyModule("pretrainedmodels"), prepend=False)
+            self.pytorch_getter.register('model', benchmarker("architectures.misc_models"))
+            self.pytorch_getter.register('loss', pml("losses"))
+            self.pytorch_getter.register('miner', pml("miners"))
+            self.pytorch_getter.register('regularizer', pml("regularizers"))
+            self.pytorch_getter.register('sampler', pml("samplers"))
+            self.pytorch_getter.register('trainer', pml("trainers"))
+            self.pytorch_getter.register('tester', pml("testers"))
+            self.pytorch_getter.register('dataset', benchmarker("datasets"))
+            self.pytorch_getter.register('api_parser', benchmarker("api_parsers"))
+            self.pytorch_getter.register('accuracy_calculator', pml("utils.accuracy_calculator", attributes=["AccuracyCalculator"]))
+            self.pytorch_getter.register('accuracy_calculator', benchmarker("utils.accuracy_calculator", attributes=["BlockwiseAccuracyCalculator"]))
+            self.pytorch_getter.register('split_manager', benchmarker("split_managers"))
+            self.pytorch_getter.register('hook_container', pml("utils.logging_presets", attributes=["HookContainer"]))
+
+
+    def pack_dataset(self, yaml_dict, name, max_shard_bytes=2**30):
+        from ..datasets.packed_shards import pack_dataset
+        dataset, dataset_params = self.pytorch_getter.get("dataset", yaml_dict=yaml_dict, return_uninitialized=True)
+        # the built-in datasets call their root folder either "root" or "dataset_root"
+        for root_param in ["root", "dataset_root"]:
+            if root_param in inspect.signature(dataset).parameters:
+                dataset_params.setdefault(root_param, self.dataset_root)
+                break
+        output_folder = os.path.join(self.dataset_root, "packed_shards", name)
+        pack_dataset(dataset(**dataset_params), output_folder, max_shard_bytes)
 
 
     def set_YR(self):
@@ -71,31 +92,33 @@ class BaseRunner:
         parser.add_argument("--resume_training", type=str, default=None, choices=["latest", "best"])
         parser.add_argument("--evaluate", action="store_true")
         parser.add_argument("--reproduce_results", type=str, default=None)
+        parser.add_argument("--profile_startup", action="store_true")
         return parser
 
 
     def setup_yaml_reader(self):
-        argparser = self.setup_argparser()
-        YR = YamlReader(argparser=argparser)
-        YR.args.dataset_root = self.dataset_root
-        YR.args.experiment_folder = os.path.join(self.root_experiment_folder, YR.args.experiment_name)
-        YR.args.place_to_save_configs = os.path.join(YR.args.experiment_folder, "configs")
-        config_foldernames_yaml = "{}.yaml".format(self.config_foldernames_base)
-        foldername_info = None
-        if not hasattr(YR.args, self.config_foldernames_base):
-            # first try loading config_foldernames from "place_to_save_configs", in case we're resuming
-            already_saved_config_foldernames = os.path.join(YR.args.place_to_save_configs, config_foldernames_yaml)
-            if os.path.isfile(already_saved_config_foldernames):
-                foldername_info = c_f.load_yaml(already_saved_config_foldernames)
-            else:
-                foldername_info = c_f.load_yaml(os.path.join(self.root_config_folder, config_foldernames_yaml))
-            YR.args.config_foldernames = foldername_info[self.config_foldernames_base]
-
-        for subfolder in YR.args.config_foldernames:
-            if not hasattr(YR.args, subfolder):
-                yaml_names = ["default"] if foldername_info is None else foldername_info[subfolder]
-                setattr(YR.args, subfolder, yaml_names)
-        return YR
+        with startup_profile.section("yaml loading"):
+            argparser = self.setup_argparser()
+            YR = YamlReader(argparser=argparser)
+            YR.args.dataset_root = self.dataset_root
+            YR.args.experiment_folder = os.path.join(self.root_experiment_folder, YR.args.experiment_name)
+            YR.args.place_to_save_configs = os.path.join(YR.args.experiment_folder, "configs")
+            config_foldernames_yaml = "{}.yaml".format(self.config_foldernames_base)
+            foldername_info = None
+            if not hasattr(YR.args, self.config_foldernames_base):
+                # first try loading config_foldernames from "place_to_save_configs", in case we're resuming
+                already_saved_config_foldernames = os.path.join(YR.args.place_to_save_configs, config_foldernames_yaml)
+                if os.path.isfile(already_saved_config_foldernames):
+                    foldername_info = c_f.load_yaml(already_saved_config_foldernames)
+                else:
+                    foldername_info = c_f.load_yaml(os.path.join(self.root_config_folder, config_foldernames_yaml))
+                YR.args.config_foldernames = foldername_info[self.config_foldernames_base]
+
+            for subfolder in YR.args.config_foldernames:
+                if not hasattr(YR.args, subfolder):
+                    yaml_names = ["default"] if foldername_info is None else foldername_info[subfolder]
+                    setattr(YR.args, subfolder, yaml_names)
+            return YR
 
 
     def determine_where_to_get_yamls(self, args):
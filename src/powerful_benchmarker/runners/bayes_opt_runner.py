@@ -1,30 +1,19 @@
 import logging
 logging.info("Importing packages in bayes_opt_runner")
-from ax.service.ax_client import AxClient
-from ax.service.utils.best_point import get_best_raw_objective_point
-from ax.plot.render import plot_config_to_html
-from ax.utils.report.render import render_report_elements
-from ax.plot.contour import interact_contour
-from ax.modelbridge.registry import Models
-from ax.core.base_trial import TrialStatus
-from ax.plot.slice import interact_slice
-from ax.plot.helper import get_range_parameters
-from ax.core.parameter import RangeParameter, ParameterType
-import re
-from easy_module_attribute_getter import utils as emag_utils, YamlReader
-import glob
-import os
-import csv
-import pandas as pd
-from ..utils import common_functions as c_f, constants as const
-from .base_runner import BaseRunner
-from .single_experiment_runner import SingleExperimentRunner
-import pytorch_metric_learning.utils.logging_presets as logging_presets
-import numpy as np
-import scipy.stats as scipy_stats
-import shutil
-import collections
-import json
+from ..utils import startup_profile
+with startup_profile.section("imports"):
+    import re
+    from easy_module_attribute_getter import utils as emag_utils, YamlReader
+    import glob
+    import os
+    import csv
+    from ..utils import common_functions as c_f, constants as const, experiment_manifest
+    from .base_runner import BaseRunner
+    from .single_experiment_runner import SingleExperimentRunner
+    import numpy as np
+    import shutil
+    import collections
+    import json
 logging.info("Done importing packages in bayes_opt_runner")
 
 
@@ -57,6 +46,7 @@ def replace_with_optimizer_values(param_path, input_dict, optimizer_value):
 
 
 def open_log(log_paths):
+    from ax.service.ax_client import AxClient
     for L in log_paths:
         try:
             ax_client = AxClient.load_from_json_file(filepath=L)
@@ -93,6 +83,8 @@ class BayesOptRunner(BaseRunner):
 
 
     def run(self):    
+        from ax.core.base_trial import TrialStatus
+        import pytorch_metric_learning.utils.logging_presets as logging_presets
         ax_client = self.get_ax_client()
         trials = ax_client.experiment.trials
         record_keeper, _, _ = logging_presets.get_record_keeper(self.csv_folder, self.tensorboard_folder)
@@ -141,6 +133,14 @@ class BayesOptRunner(BaseRunner):
         return os.path.join(self.bayes_opt_root_experiment_folder, sub_experiment_name)
 
 
+    # Bayes opt experiments that were created before the manifest existed are found by globbing.
+    def get_sub_experiment_names_with_prefix(self, prefix):
+        sub_experiments = experiment_manifest.get_sub_experiments(self.bayes_opt_root_experiment_folder)
+        if sub_experiments is None:
+            return [os.path.basename(e) for e in glob.glob(os.path.join(self.bayes_opt_root_experiment_folder, "%s*"%prefix))]
+        return [e for e in sub_experiments if e.startswith(prefix)]
+
+
     def get_sub_experiment_bayes_opt_filename(self, sub_experiment_path):
         return os.path.join(sub_experiment_path, "bayes_opt_parameters.yaml")
 
@@ -166,6 +166,7 @@ class BayesOptRunner(BaseRunner):
         record_keeper.save_records()
 
     def save_best_parameters(self, record_keeper, ax_client):
+        from ax.service.utils.best_point import get_best_raw_objective_point
         q = record_keeper.query("SELECT * FROM {0} WHERE {1}=(SELECT max({1}) FROM {0})".format(self.bayes_opt_table_name, self.eval_primary_metric))[0]
         best_trial_index = int(q['trial_index'])
         best_sub_experiment_name = self.get_sub_experiment_name(best_trial_index)
@@ -180,13 +181,13 @@ class BayesOptRunner(BaseRunner):
         return best_sub_experiment_name
 
     def create_accuracy_report(self, best_sub_experiment_name):
+        import scipy.stats as scipy_stats
+        import pytorch_metric_learning.utils.logging_presets as logging_presets
         dummy_YR = self.read_yaml_and_find_bayes(find_bayes_params=False, merge_argparse=True)
         dummy_api_parser = self.get_api_parser(dummy_YR.args)
         eval_record_group_dicts = dummy_api_parser.get_eval_record_name_dict(return_all=True)
         global_record_keeper, _, _ = logging_presets.get_record_keeper(self.csv_folder, self.tensorboard_folder, self.global_db_path, "", False)
-        exp_names = glob.glob(os.path.join(self.bayes_opt_root_experiment_folder, "%s*"%best_sub_experiment_name))
-
-        exp_names = [os.path.basename(e) for e in exp_names]
+        exp_names = self.get_sub_experiment_names_with_prefix(best_sub_experiment_name)
         results, summary = {}, {}
 
         for eval_type in c_f.if_str_convert_to_singleton_list(dummy_YR.args.meta_testing_method):
@@ -235,6 +236,7 @@ class BayesOptRunner(BaseRunner):
 
 
     def update_bayes_opt_search_space(self, ax_client):
+        from ax.core.parameter import RangeParameter, ParameterType
         for bp in self.bayes_params:
             kwargs_dict = {"name": bp["name"], "lower": bp["bounds"][0], "upper": bp["bounds"][1]}
             kwargs_dict["parameter_type"] = ParameterType.FLOAT if bp["value_type"] == "float" else ParameterType.INT
@@ -242,6 +244,7 @@ class BayesOptRunner(BaseRunner):
             ax_client.experiment.search_space.update_parameter(RangeParameter(**kwargs_dict))
 
     def get_ax_client(self):
+        from ax.service.ax_client import AxClient
         log_paths = self.get_all_log_paths()
         ax_client = None
         if len(log_paths) > 0:
@@ -254,6 +257,12 @@ class BayesOptRunner(BaseRunner):
 
 
     def plot_progress(self, ax_client):
+        from ax.modelbridge.registry import Models
+        from ax.plot.render import plot_config_to_html
+        from ax.utils.report.render import render_report_elements
+        from ax.plot.contour import interact_contour
+        from ax.plot.slice import interact_slice
+        from ax.plot.helper import get_range_parameters
         model = Models.GPEI(experiment=ax_client.experiment, data=ax_client.experiment.fetch_data())
         html_elements = [plot_config_to_html(ax_client.get_optimization_trace())]
         model_params = get_range_parameters(model)
@@ -274,11 +283,13 @@ class BayesOptRunner(BaseRunner):
 
         config_paths = self.get_saved_config_paths(YR.args) if bayes_opt_config_exists else self.get_root_config_paths(YR.args)
         merge_argparse = (self.merge_argparse_when_resuming or merge_argparse) if bayes_opt_config_exists else True
-        YR.args, _, YR.args.dict_of_yamls = YR.load_yamls(config_paths = config_paths, 
-                                                        max_merge_depth = float('inf'), 
-                                                        merge_argparse = merge_argparse)
+        with startup_profile.section("yaml loading"):
+            YR.args, _, YR.args.dict_of_yamls = YR.load_yamls(config_paths = config_paths, 
+                                                            max_merge_depth = float('inf'), 
+                                                            merge_argparse = merge_argparse)
 
         if not bayes_opt_config_exists:                                         
+            experiment_manifest.create_manifest(self.bayes_opt_root_experiment_folder)
             c_f.save_config_files(YR.args.place_to_save_configs, YR.args.dict_of_yamls, False, [])
 
         if find_bayes_params:
@@ -307,8 +318,10 @@ class BayesOptRunner(BaseRunner):
         return YR
 
     def delete_sub_experiment_folder(self, sub_experiment_name):
+        import pytorch_metric_learning.utils.logging_presets as logging_presets
         logging.warning("Deleting and starting fresh for %s"%sub_experiment_name)
         shutil.rmtree(self.get_sub_experiment_path(sub_experiment_name))
+        experiment_manifest.remove_sub_experiment(self.bayes_opt_root_experiment_folder, sub_experiment_name)
         global_record_keeper, _, _ = logging_presets.get_record_keeper(self.csv_folder, self.tensorboard_folder, self.global_db_path, sub_experiment_name, False)
         global_record_keeper.record_writer.global_db.delete_experiment(sub_experiment_name)
 
@@ -355,6 +368,7 @@ class BayesOptRunner(BaseRunner):
         local_YR.args.resume_training = None
         self.set_experiment_name_and_place_to_save_configs(local_YR)
         c_f.makedir_if_not_there(local_YR.args.experiment_folder)
+        experiment_manifest.record_sub_experiment(self.bayes_opt_root_experiment_folder, sub_experiment_name)
         c_f.write_yaml(self.get_sub_experiment_bayes_opt_filename(local_YR.args.experiment_folder), parameters, open_as='w')
         SER = self.get_single_experiment_runner()
         return SER.start_experiment(local_YR.args)
@@ -386,6 +400,7 @@ class BayesOptRunner(BaseRunner):
                 SER = self.get_single_experiment_runner()
                 starting_fresh_hook = self.starting_fresh(local_YR.args.experiment_name)
                 SER.reproduce_results(local_YR, starting_fresh_hook=starting_fresh_hook)
+            experiment_manifest.record_sub_experiment(self.bayes_opt_root_experiment_folder, local_YR.args.experiment_name)
             self.test_model(local_YR.args.experiment_name)
 
 
@@ -1,10 +1,12 @@
 #! /usr/bin/env python3
 import logging
 logging.info("Importing packages in single_experiment_runner")
-from ..utils import common_functions as c_f, dataset_utils as d_u
-from .base_runner import BaseRunner
-import glob
-import os
+from ..utils import startup_profile
+with startup_profile.section("imports"):
+    from ..utils import common_functions as c_f, dataset_utils as d_u
+    from .base_runner import BaseRunner
+    import os
+    from collections import defaultdict
 logging.info("Done importing packages in single_experiment_runner")
 
 
@@ -28,26 +30,30 @@ class SingleExperimentRunner(BaseRunner):
     def run_new_experiment_or_resume(self, YR):
         # merge_argparse at the beginning of training, or when evaluating
         merge_argparse = self.merge_argparse_when_resuming if YR.args.resume_training else True
-        args, _, args.dict_of_yamls = YR.load_yamls(self.determine_where_to_get_yamls(YR.args), 
-                                                    max_merge_depth=float('inf'), 
-                                                    merge_argparse=merge_argparse)
+        with startup_profile.section("yaml loading"):
+            args, _, args.dict_of_yamls = YR.load_yamls(self.determine_where_to_get_yamls(YR.args), 
+                                                        max_merge_depth=float('inf'), 
+                                                        merge_argparse=merge_argparse)
         return self.start_experiment(args)
 
     def reproduce_results(self, YR, starting_fresh_hook=None):
         configs_folder = os.path.join(YR.args.reproduce_results, 'configs')
-        all_config_paths = self.get_root_config_paths(YR.args)
+        # the experiment being reproduced is only read, so the snapshots of its configs are saved in this experiment
+        snapshots_folder = os.path.join(YR.args.place_to_save_configs, c_f.REPRODUCED_CONFIG_SNAPSHOTS_FOLDER_NAME)
+        root_config_paths = self.get_root_config_paths(YR.args)
         experiment_config_paths = self.get_saved_config_paths(YR.args, config_folder=configs_folder)
-        for k, v in experiment_config_paths.items():
-            all_config_paths[k].extend(v)
-        args, _, args.dict_of_yamls = YR.load_yamls(config_paths=all_config_paths, 
-                                                    max_merge_depth=0, 
-                                                    merge_argparse=self.merge_argparse_when_resuming)
+        all_config_paths = self.combine_config_paths(root_config_paths, experiment_config_paths)
+        with startup_profile.section("yaml loading"):
+            args, _, args.dict_of_yamls = YR.load_yamls(config_paths=all_config_paths, 
+                                                        max_merge_depth=0, 
+                                                        merge_argparse=self.merge_argparse_when_resuming)
 
         # check if there were config diffs if training was resumed
         temp_split_manager = self.pytorch_getter.get("split_manager", yaml_dict=args.split_manager)
-        resume_training_dict = c_f.get_all_resume_training_config_diffs(configs_folder, temp_split_manager)
+        resume_training_dict = c_f.get_all_resume_training_config_diffs(configs_folder, temp_split_manager, write_manifest=False)
 
         if len(resume_training_dict) > 0:
+            config_diff_folders = []
             for sub_folder, num_epochs_dict in resume_training_dict.items():
                 # train until the next config diff was made
                 args.num_epochs_train = num_epochs_dict
@@ -55,12 +61,20 @@ class SingleExperimentRunner(BaseRunner):
                 # Start fresh
                 YR = self.setup_yaml_reader()
                 if starting_fresh_hook: starting_fresh_hook(YR)
-                # load the default configs, the experiment specific configs, plus the config diffs 
-                for k in glob.glob(os.path.join(sub_folder, "*")):
-                    config_name = os.path.splitext(os.path.basename(k))[0]
-                    all_config_paths[config_name].append(k)
-                args, _, args.dict_of_yamls = YR.load_yamls(config_paths=all_config_paths, 
-                                                            max_merge_depth=0, 
-                                                            merge_argparse=self.merge_argparse_when_resuming)
+                # load the default configs, plus the experiment specific configs merged with the config diffs so far
+                config_diff_folders.append(sub_folder)
+                merged_config_paths = c_f.get_merged_config_paths(configs_folder, list(experiment_config_paths.keys()), config_diff_folders, snapshots_folder)
+                all_config_paths = self.combine_config_paths(root_config_paths, merged_config_paths)
+                with startup_profile.section("yaml loading"):
+                    args, _, args.dict_of_yamls = YR.load_yamls(config_paths=all_config_paths, 
+                                                                max_merge_depth=0, 
+                                                                merge_argparse=self.merge_argparse_when_resuming)
                 args.resume_training = "latest"
-        return self.start_experiment(args)
\ No newline at end of file
+        return self.start_experiment(args)
+
+    def combine_config_paths(self, *list_of_config_paths):
+        all_config_paths = defaultdict(list)
+        for config_paths in list_of_config_paths:
+            for k, v in config_paths.items():
+                all_config_paths[k].extend(v)
+        return all_config_paths
\ No newline at end of file
@@ -4,12 +4,29 @@ from collections import OrderedDict
 import numpy as np
 import torch
 from ..utils import dataset_utils as d_u, common_functions as c_f
+from ..utils.label_index import LabelIndex
 import logging
-import itertools
 from collections import defaultdict
 from .split_scheme_holder import SplitSchemeHolder
 import copy
 
+
+# equality is transitive, so comparing each array to the first one is enough
+def arrays_are_equal(arrays):
+    return all(np.array_equal(arrays[0], x) for x in arrays[1:])
+
+# arrays of different shapes are never equal, so duplicates are searched for within each shape
+def arrays_are_distinct(arrays):
+    arrays_by_shape = defaultdict(list)
+    for x in arrays:
+        arrays_by_shape[x.shape].append(x.reshape(-1))
+    return all(len(np.unique(np.stack(v), axis=0)) == len(v) for v in arrays_by_shape.values())
+
+# after removing duplicates within each array, any repeated value must come from two different arrays
+def arrays_are_disjoint(arrays):
+    all_values = np.concatenate([np.unique(x) for x in arrays])
+    return len(np.unique(all_values)) == len(all_values)
+
 class BaseSplitManager:
     def __init__(self, 
         hierarchy_level=0,
@@ -23,6 +40,14 @@ class BaseSplitManager:
         self.label_set_attr_name = label_set_attr_name
         self.split_scheme_holder = SplitSchemeHolder()
         self.split_names = ["train", "val", "test"]
+        # if set, split managers that support it will save and reuse their split indices at this path
+        self.split_indices_path = None
+        self.label_indices = {}
+
+    def get_split_params(self):
+        split_params = {k: getattr(self, k) for k in ["hierarchy_level", "labels_attr_name", "label_set_attr_name", "split_names"]}
+        split_params["split_manager"] = type(self).__name__
+        return split_params
 
     def dataset_attribute_to_assert(self, dataset):
         return dataset.indices
@@ -34,6 +59,9 @@ class BaseSplitManager:
             names = self.split_scheme_holder.get_transform_types()
         elif across_what == "split_names":
             names = self.split_scheme_holder.get_split_names()
+        assertion_funcs = {"equal": arrays_are_equal, "not_equal": arrays_are_distinct, "disjoint": arrays_are_disjoint}
+        if assertion not in assertion_funcs:
+            raise ValueError('The assertion argument must be one of ["equal", "not_equal", "disjoint"]')
         if attribute_getter is None:
             attribute_getter = self.dataset_attribute_to_assert
         datasets = []
@@ -44,17 +72,9 @@ class BaseSplitManager:
         if not within_group:
             datasets = zip(*datasets)
         for ds in datasets:
-            for (x,y) in itertools.combinations(ds, 2):
-                x_a, y_a = attribute_getter(x), attribute_getter(y)
-                is_equal = np.array_equal(x_a, y_a)
-                if assertion == "equal":
-                    assert is_equal
-                elif assertion == "not_equal":
-                    assert not is_equal
-                elif assertion == "disjoint":
-                    assert len(np.intersect1d(x_a, y_a)) == 0
-                else:
-                    raise ValueError('The assertion argument must be one of ["equal", "not_equal", "disjoint"]')
+            if len(ds) < 2:
+                continue
+            assert assertion_funcs[assertion]([np.asarray(attribute_getter(x)) for x in ds])
         input_kwargs_as_string = ", ".join(["{}={}".format(k, v) for k,v in input_kwargs.items()])
         splits = input_kwargs.pop("split_names")
         across_or_within = "across" if not within_group else "within"
@@ -64,6 +84,7 @@ class BaseSplitManager:
     # {train_transform: {train: dataset, val: dataset, test: dataset}, eval_transform:: {train: dataset, val: dataset, test: dataset}}
     # Each provided dataset is assumed to be identical. The purpose of providing multiple copies is to keep the underlying objects separate.
     def create_split_schemes(self, datasets):
+        self.label_indices = {}
         self.split_scheme_holder.set_split_schemes(self._create_split_schemes(datasets))
         self.split_assertions()
         
@@ -84,20 +105,33 @@ class BaseSplitManager:
     def get_dataset(self, *args, **kwargs):
         return self.split_scheme_holder.get_dataset(*args, **kwargs)
 
-    def get_labels(self, *args, dataset=None, **kwargs):
+    # The label index of each dataset is computed once. The dataset is stored
+    # alongside its label index, so that its id can't be reused by another object.
+    def get_label_index(self, *args, dataset=None, **kwargs):
         dataset = self.get_dataset(*args, **kwargs) if dataset is None else dataset
-        return d_u.get_dataset_labels(dataset, self.labels_attr_name)
+        if id(dataset) not in self.label_indices:
+            self.label_indices[id(dataset)] = (dataset, LabelIndex(d_u.get_dataset_labels(dataset, self.labels_attr_name)))
+        return self.label_indices[id(dataset)][1]
+
+    def get_labels(self, *args, dataset=None, **kwargs):
+        return self.get_label_index(*args, dataset=dataset, **kwargs).get_labels()
+
+    def get_unique_labels(self, *args, dataset=None, **kwargs):
+        if self.label_set_attr_name:
+            return np.array(sorted(self.get_label_set(*args, dataset=dataset, **kwargs)))
+        return self.get_label_index(*args, dataset=dataset, **kwargs).get_unique_labels(self.hierarchy_level)
 
     def get_label_set(self, *args, dataset=None, **kwargs):
         if self.label_set_attr_name:
             dataset = self.get_dataset(*args, **kwargs) if dataset is None else dataset
             return d_u.get_dataset_attr(dataset, self.label_set_attr_name)
         else:
-            labels = self.get_labels(*args, dataset=dataset, **kwargs)
-            return d_u.get_label_set(labels, self.hierarchy_level)
+            return set(self.get_unique_labels(*args, dataset=dataset, **kwargs))
 
     def get_num_labels(self, *args, dataset=None, **kwargs):
-        return len(self.get_label_set(*args, dataset=dataset, **kwargs))
+        if self.label_set_attr_name:
+            return len(self.get_label_set(*args, dataset=dataset, **kwargs))
+        return len(self.get_unique_labels(*args, dataset=dataset, **kwargs))
 
     def get_dataset_dict(self, *args, **kwargs):
         return self.split_scheme_holder.get_dataset_dict(*args, **kwargs)
@@ -125,6 +159,7 @@ class BaseSplitManager:
         raise NotImplementedError
 
     def set_data_and_label_getter(self, data_and_label_getter_keys):
+        self.data_and_label_getter_keys = data_and_label_getter_keys
         if data_and_label_getter_keys is None:
             self.data_and_label_getter = lambda data: data
         else:
@@ -5,7 +5,7 @@ import numpy as np
 class ClassDisjointSplitManager(IndexSplitManager):
 
     def get_list_for_splitting(self, dataset):
-        return sorted(list(self.get_label_set(dataset=dataset)))
+        return self.get_unique_labels(dataset=dataset)
 
     def convert_to_subset_idx(self, dataset, split_from_kfolder):
         return np.where(np.isin(self.get_labels(dataset=dataset), split_from_kfolder))[0]
@@ -15,8 +15,9 @@ class ClassDisjointSplitManager(IndexSplitManager):
         trainval_set = np.array(sorted(list(self.get_label_set(dataset=dataset) - set(test_set))))
         return trainval_set, test_set
 
+    # the unique labels at the current hierarchy level, which come from the label index
     def get_list_for_class_disjoint_assertion(self, dataset):
-        return self.get_list_for_splitting(dataset)
+        return self.get_unique_labels(dataset=dataset)
 
     def class_disjoint_assertion(self):
         for t_type in self.split_scheme_holder.get_transform_types():
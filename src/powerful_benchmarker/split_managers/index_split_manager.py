@@ -4,6 +4,10 @@ import itertools
 from sklearn.model_selection import train_test_split, KFold
 import numpy as np
 import logging
+import hashlib
+import json
+import os
+from collections import OrderedDict
 
 class IndexSplitManager(BaseSplitManager):
     def __init__(self,
@@ -54,13 +58,68 @@ class IndexSplitManager(BaseSplitManager):
         trainval_set = np.array(list(set(range(len(dataset))) - set(test_set)))
         return trainval_set, test_set
 
+    def get_split_params(self):
+        split_params = super().get_split_params()
+        for k in ["num_training_partitions", "num_training_sets", "test_size", "test_start_idx", "shuffle", "random_seed"]:
+            split_params[k] = getattr(self, k)
+        if self.helper_split_manager is not None:
+            split_params["helper_split_manager"] = self.helper_split_manager.get_split_params()
+        return split_params
+
+    def get_split_indices_key(self, dataset):
+        labels = np.ascontiguousarray(self.get_labels(dataset=dataset))
+        # format 2 stores the indices before they are converted into subset indices of each dataset
+        dataset_identity = {"format": 2,
+                            "dataset": type(d_u.get_underlying_dataset(dataset)).__name__, 
+                            "length": len(dataset), 
+                            "labels_shape": labels.shape, 
+                            "labels_dtype": labels.dtype.str}
+        key = hashlib.md5(json.dumps([self.get_split_params(), dataset_identity], sort_keys=True, default=str).encode("utf-8"))
+        key.update(labels.tobytes())
+        return key.hexdigest()
+
+    def load_split_indices(self, key):
+        if self.split_indices_path is None or not os.path.isfile(self.split_indices_path):
+            return None
+        with np.load(self.split_indices_path) as saved:
+            if str(saved["__key__"]) != key:
+                logging.warning("The split indices in {} were computed for a different dataset or different split parameters. "
+                                "They will be recomputed and overwritten.".format(self.split_indices_path))
+                return None
+            split_indices = OrderedDict()
+            for name in saved["__split_scheme_names__"]:
+                split_indices[str(name)] = OrderedDict((str(k), saved["{}|{}".format(name, k)]) for k in saved["__split_names__"])
+        logging.info("Loaded split indices from {}".format(self.split_indices_path))
+        return split_indices
+
+    def save_split_indices(self, key, split_indices):
+        if self.split_indices_path is None:
+            return
+        arrays = {"{}|{}".format(name, k): v for name, split_dict in split_indices.items() for k, v in split_dict.items()}
+        split_names = list(c_f.first_val_of_dict(split_indices).keys())
+        c_f.makedir_if_not_there(os.path.dirname(self.split_indices_path))
+        tmp_path = "{}.tmp.npz".format(self.split_indices_path)
+        np.savez(tmp_path, __key__=key, __split_scheme_names__=list(split_indices.keys()), __split_names__=split_names, **arrays)
+        os.replace(tmp_path, self.split_indices_path)
+
     def _create_split_schemes(self, datasets):
         # the assumption is all datasets are the same
         sample_dataset = c_f.first_val_of_dict(c_f.first_val_of_dict(datasets))
-
         if self.helper_split_manager is not None:
+            # created even if the split indices are loaded, because its split schemes are used later
             logging.info("***Using helper_split_manager to create the test set***")
             self.helper_split_manager.create_split_schemes(datasets)
+        key = self.get_split_indices_key(sample_dataset)
+        split_indices = self.load_split_indices(key)
+        if split_indices is None:
+            split_indices = self.compute_split_indices(sample_dataset)
+            self.save_split_indices(key, split_indices)
+        # converted for each dataset, like before the split indices were saved
+        return d_u.create_subset_datasets_from_split_indices(datasets, split_indices, self.convert_to_subset_idx)
+
+    # the returned indices are the ones that convert_to_subset_idx takes, like class labels for ClassDisjointSplitManager
+    def compute_split_indices(self, sample_dataset):
+        if self.helper_split_manager is not None:
             trainval_set, test_set = self.get_trainval_and_test_from_helper_split_manager(sample_dataset)
         else:
             list_for_splitting = np.array(self.get_list_for_splitting(sample_dataset))
@@ -72,13 +131,15 @@ class IndexSplitManager(BaseSplitManager):
             trainval_set, test_set = self.get_trainval_and_test(sample_dataset, list_for_splitting)
 
         trainval_idx_tuples = self.get_kfold_generator(sample_dataset, trainval_set)
-        return d_u.create_subset_datasets_from_indices(datasets, 
-                                                        trainval_idx_tuples,
-                                                        trainval_set, 
-                                                        test_set, 
-                                                        self.get_split_scheme_name,
-                                                        self.num_training_sets,
-                                                        self.convert_to_subset_idx)
+        split_indices = d_u.get_split_indices(trainval_idx_tuples,
+                                            np.asarray(trainval_set), 
+                                            test_set, 
+                                            self.get_split_scheme_name,
+                                            self.num_training_sets)
+        for split_dict in split_indices.values():
+            for k, v in split_dict.items():
+                split_dict[k] = np.asarray(v)
+        return split_indices
 
 
     def get_test_set_name(self):
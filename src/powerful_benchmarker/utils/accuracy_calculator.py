@@ -0,0 +1,86 @@
+#! /usr/bin/env python3
+
+import torch
+import numpy as np
+import logging
+from pytorch_metric_learning.utils import accuracy_calculator as pml_accuracy_calculator
+
+
+def get_knn(reference_embeddings, test_embeddings, k, embeddings_come_from_same_source=False, max_memory_mb=1024, min_query_block_size=256):
+    """
+    Exact k nearest neighbors (squared L2 distance), with the same outputs as pytorch_metric_learning's stat_utils.get_knn.
+    The distance matrix is computed in tiles of query and reference embeddings,
+    so that at most max_memory_mb is used for distances at a time.
+    """
+    num_k = k + 1
+    reference = torch.from_numpy(np.ascontiguousarray(reference_embeddings, dtype=np.float32))
+    query = torch.from_numpy(np.ascontiguousarray(test_embeddings, dtype=np.float32))
+    num_k = min(num_k, len(reference))
+    max_elements = max_memory_mb * 2**20 // 4
+    reference_block_size = int(min(len(reference), max(num_k, max_elements // (2 * min_query_block_size))))
+    query_block_size = int(max(1, max_elements // (2 * (reference_block_size + num_k))))
+    logging.info("running blockwise k-nn with k=%d, query block size %d, reference block size %d"%(k, query_block_size, reference_block_size))
+
+    # computed in blocks too, so that memory-mapped embeddings aren't loaded all at once
+    reference_sq_norms = torch.cat([(reference[rs:rs+reference_block_size]**2).sum(dim=1) for rs in range(0, len(reference), reference_block_size)])
+    all_distances = np.zeros((len(query), num_k), dtype=np.float32)
+    all_indices = np.zeros((len(query), num_k), dtype=np.int64)
+    for qs in range(0, len(query), query_block_size):
+        q = query[qs:qs+query_block_size]
+        q_sq_norms = (q**2).sum(dim=1, keepdim=True)
+        best_distances, best_indices = None, None
+        for rs in range(0, len(reference), reference_block_size):
+            r = reference[rs:rs+reference_block_size]
+            distances = torch.addmm(reference_sq_norms[rs:rs+reference_block_size].unsqueeze(0), q, r.t(), alpha=-2).add_(q_sq_norms).clamp_(min=0)
+            indices = torch.arange(rs, rs+len(r)).expand(len(q), -1)
+            if best_distances is not None:
+                distances = torch.cat([best_distances, distances], dim=1)
+                indices = torch.cat([best_indices, indices], dim=1)
+            best_distances, topk_idx = torch.topk(distances, min(num_k, distances.size(1)), dim=1, largest=False, sorted=True)
+            best_indices = torch.gather(indices, 1, topk_idx)
+        all_distances[qs:qs+len(q)] = best_distances.numpy()
+        all_indices[qs:qs+len(q)] = best_indices.numpy()
+
+    if embeddings_come_from_same_source:
+        return all_indices[:, 1:], all_distances[:, 1:]
+    return all_indices[:, :k], all_distances[:, :k]
+
+
+class BlockwiseAccuracyCalculator(pml_accuracy_calculator.AccuracyCalculator):
+    """
+    The same metrics as AccuracyCalculator, but the k nearest neighbors are computed
+    in blocks that use at most max_memory_mb of memory for distances,
+    using torch's CPU threads, instead of building a single faiss index.
+    """
+    def __init__(self, *args, max_memory_mb=1024, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_memory_mb = max_memory_mb
+
+    def get_accuracy(self, query, reference, query_labels, reference_labels, embeddings_come_from_same_source, include=(), exclude=()):
+        embeddings_come_from_same_source = embeddings_come_from_same_source or (query is reference)
+
+        self.curr_function_dict = self.get_function_dict(include, exclude)
+
+        kwargs = {"query": query,
+                "reference": reference,
+                "query_labels": query_labels,
+                "reference_labels": reference_labels,
+                "embeddings_come_from_same_source": embeddings_come_from_same_source}
+
+        if any(x in self.requires_knn() for x in self.get_curr_metrics()):
+            label_counts, num_k = pml_accuracy_calculator.get_label_counts(reference_labels)
+            if self.k is not None: num_k = self.k
+            knn_indices, knn_distances = get_knn(reference, query, num_k, embeddings_come_from_same_source, self.max_memory_mb)
+            knn_labels = reference_labels[knn_indices]
+            lone_query_labels = pml_accuracy_calculator.get_lone_query_labels(query_labels, reference_labels, label_counts, embeddings_come_from_same_source)
+            not_lone_query_idx = ~np.isin(query_labels, lone_query_labels)
+            kwargs["label_counts"] = label_counts
+            kwargs["knn_labels"] = knn_labels
+            kwargs["knn_distances"] = knn_distances
+            kwargs["lone_query_labels"] = lone_query_labels
+            kwargs["not_lone_query_idx"] = not_lone_query_idx
+
+        if any(x in self.requires_clustering() for x in self.get_curr_metrics()):
+            kwargs["cluster_labels"] = self.get_cluster_labels(**kwargs)
+
+        return self._get_accuracy(self.curr_function_dict, **kwargs)
@@ -0,0 +1,202 @@
+#! /usr/bin/env python3
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import os
+import shutil
+import tarfile
+import threading
+import time
+import zipfile
+import tqdm
+from . import common_functions as c_f
+
+CHUNK_SIZE = 2**20
+
+
+class HashingReader:
+    """
+    Wraps a file object, and updates an md5 hash with every byte that is read.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.md5.update(data)
+        return data
+
+    def read_to_end(self):
+        while self.read(CHUNK_SIZE):
+            pass
+        return self.md5.hexdigest()
+
+
+def get_output_path(extract_to, member_name):
+    output_path = os.path.realpath(os.path.join(extract_to, member_name))
+    if os.path.commonpath([output_path, os.path.realpath(extract_to)]) != os.path.realpath(extract_to):
+        raise RuntimeError("Archive member %s would be extracted outside of %s"%(member_name, extract_to))
+    return output_path
+
+
+def already_extracted(output_path, size):
+    return os.path.isfile(output_path) and os.path.getsize(output_path) == size
+
+
+class ExtractionProgress:
+    """
+    Records the members of an archive that have been extracted, so that an interrupted installation can be resumed.
+    The record is reset when the archive changes, like when it is downloaded again.
+    If the md5 turns out to be wrong, every extracted file is deleted along with the record,
+    so that files from a corrupted archive are never skipped by a later installation.
+    """
+    def __init__(self, archive_path, extract_to):
+        self.path = os.path.join(extract_to, ".%s.extracted"%os.path.basename(archive_path))
+        stat = os.stat(archive_path)
+        self.archive_id = "%d %d"%(stat.st_size, stat.st_mtime_ns)
+        self.done = set()
+        if os.path.isfile(self.path):
+            with open(self.path, "r") as f:
+                lines = f.read().splitlines()
+            if len(lines) > 0 and lines[0] == self.archive_id:
+                self.done = set(lines[1:])
+        c_f.makedir_if_not_there(extract_to)
+        self.file = open(self.path, "w")
+        self.file.write("\n".join([self.archive_id] + sorted(self.done)) + "\n")
+        self.file.flush()
+        self.output_paths = []
+        self.lock = threading.Lock()
+
+    def is_done(self, member_name, output_path, size):
+        self.output_paths.append(output_path)
+        return member_name in self.done and already_extracted(output_path, size)
+
+    def mark_done(self, member_name):
+        with self.lock:
+            self.file.write(member_name + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def delete_extracted_files(self):
+        self.close()
+        for x in self.output_paths + [self.path]:
+            if os.path.isfile(x): os.remove(x)
+
+
+def extract_special_member(tar, member, extract_to):
+    # links and other special members, which are extracted the safe way when tarfile supports extraction filters
+    if hasattr(tarfile, "data_filter"):
+        tar.extract(member, path=extract_to, filter="data")
+    elif member.issym() or member.islnk():
+        link_target = os.path.join(os.path.dirname(member.name), member.linkname) if member.issym() else member.linkname
+        if os.path.isabs(member.linkname):
+            raise RuntimeError("Archive member %s links to the absolute path %s"%(member.name, member.linkname))
+        get_output_path(extract_to, link_target)
+        tar.extract(member, path=extract_to)
+    else:
+        logging.warning("Skipping archive member %s, which is not a file, directory or link"%member.name)
+
+
+def write_file(output_path, data):
+    c_f.makedir_if_not_there(os.path.dirname(output_path))
+    with open(output_path, "wb") as f:
+        f.write(data)
+
+
+def install_tar(archive_path, extract_to, num_workers, progress):
+    # Tar members can only be read in order, so decompression stays sequential,
+    # while the md5 is computed on the same stream and the writes are done in parallel.
+    # The semaphore bounds the number of decompressed members held in memory.
+    slots = threading.BoundedSemaphore(num_workers*4)
+    def write_and_release(member_name, output_path, data):
+        try:
+            write_file(output_path, data)
+            progress.mark_done(member_name)
+        finally:
+            slots.release()
+    num_skipped = 0
+    with open(archive_path, "rb") as f, ThreadPoolExecutor(num_workers) as pool:
+        reader = HashingReader(f)
+        futures = []
+        with tarfile.open(fileobj=reader, mode="r|*") as tar:
+            for member in tqdm.tqdm(tar):
+                output_path = get_output_path(extract_to, member.name)
+                if member.isdir():
+                    c_f.makedir_if_not_there(output_path)
+                elif member.isfile():
+                    if progress.is_done(member.name, output_path, member.size):
+                        num_skipped += 1
+                        continue
+                    data = tar.extractfile(member).read()
+                    slots.acquire()
+                    futures.append(pool.submit(write_and_release, member.name, output_path, data))
+                else:
+                    extract_special_member(tar, member, extract_to)
+        for fut in futures:
+            fut.result()
+        return reader.read_to_end(), num_skipped
+
+
+def install_zip(archive_path, extract_to, num_workers, progress):
+    # Zip members are independently addressable, so each worker opens its own
+    # ZipFile and extracts a subset of members, while the md5 is computed in a separate sequential pass.
+    local = threading.local()
+    zip_refs, zip_refs_lock = [], threading.Lock()
+    def extract_member(info):
+        output_path = get_output_path(extract_to, info.filename)
+        if info.is_dir():
+            c_f.makedir_if_not_there(output_path)
+            return False
+        if not hasattr(local, "zip_ref"):
+            local.zip_ref = zipfile.ZipFile(archive_path, "r")
+            with zip_refs_lock:
+                zip_refs.append(local.zip_ref)
+        c_f.makedir_if_not_there(os.path.dirname(output_path))
+        with local.zip_ref.open(info) as src, open(output_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        progress.mark_done(info.filename)
+        return False
+    def compute_md5():
+        with open(archive_path, "rb") as f:
+            return HashingReader(f).read_to_end()
+    with zipfile.ZipFile(archive_path, "r") as zip_ref:
+        infolist = zip_ref.infolist()
+    # checked up front, on the main thread, so that progress.output_paths includes every file member
+    skipped = [not info.is_dir() and progress.is_done(info.filename, get_output_path(extract_to, info.filename), info.file_size) for info in infolist]
+    try:
+        with ThreadPoolExecutor(num_workers+1) as pool:
+            md5_future = pool.submit(compute_md5)
+            list(tqdm.tqdm(pool.map(extract_member, [x for x, y in zip(infolist, skipped) if not y]), total=len(infolist)-sum(skipped)))
+            return md5_future.result(), sum(skipped)
+    finally:
+        for x in zip_refs:
+            x.close()
+
+
+def install_archive(archive_path, extract_to, md5=None, num_workers=None):
+    """
+    Extracts a local tar or zip archive, and verifies its md5 while extracting.
+    Members that were extracted from the same archive by an interrupted installation are skipped.
+    If the md5 is wrong, the extracted files are deleted.
+    """
+    num_workers = os.cpu_count() if num_workers is None else num_workers
+    logging.info("Installing %s into %s"%(archive_path, extract_to))
+    start = time.time()
+    progress = ExtractionProgress(archive_path, extract_to)
+    try:
+        if zipfile.is_zipfile(archive_path):
+            archive_md5, num_skipped = install_zip(archive_path, extract_to, num_workers, progress)
+        else:
+            archive_md5, num_skipped = install_tar(archive_path, extract_to, num_workers, progress)
+    finally:
+        progress.close()
+    elapsed = time.time() - start
+    archive_mb = os.path.getsize(archive_path) / 2**20
+    logging.info("Installed %.1f MB in %.1f seconds (%.1f MB/s), skipped %d already-extracted files"%(archive_mb, elapsed, archive_mb / max(elapsed, 1e-6), num_skipped))
+    if md5 is not None and archive_md5 != md5:
+        progress.delete_extracted_files()
+        raise RuntimeError("md5 of %s is %s, but expected %s. The archive is corrupted, and should be deleted and downloaded again."%(archive_path, archive_md5, md5))
@@ -0,0 +1,170 @@
+#! /usr/bin/env python3
+
+import torch
+import copy
+import logging
+import os
+import queue
+import traceback
+from collections import defaultdict
+from . import common_functions as c_f, checkpoint_writer
+from .checkpoint_writer import get_state_dict
+
+# seconds between checks that the evaluation process is still alive, while waiting for it
+POLL_INTERVAL = 1
+
+
+def snapshot_state_dicts(trainer, saveable_trainer_objects):
+    return {x: {k: copy.deepcopy(get_state_dict(v)) for k, v in getattr(trainer, x, {}).items()} for x in saveable_trainer_objects}
+
+
+def _evaluation_loop(tester, dataset_dict, trunk, embedder, collate_fn, job_queue, result_queue, parent_pid):
+    # the records are written by the training process, so the forked tester only computes accuracies
+    tester.end_of_testing_hook = None
+    while True:
+        try:
+            job = job_queue.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            if os.getppid() != parent_pid:
+                return
+            continue
+        if job is None:
+            return
+        epoch, trunk_state_dict, embedder_state_dict = job
+        try:
+            for model, state_dict in [(trunk, trunk_state_dict), (embedder, embedder_state_dict)]:
+                model = model.module if isinstance(model, torch.nn.DataParallel) else model
+                model.load_state_dict(state_dict)
+            tester.test(dataset_dict, epoch, trunk, embedder, list(dataset_dict.keys()), collate_fn)
+        except Exception:
+            # sent to the training process, which raises it
+            result_queue.put((epoch, None, traceback.format_exc()))
+            return
+        result_queue.put((epoch, {k: dict(v) for k, v in tester.all_accuracies.items()}, None))
+
+
+class BackgroundEvaluator:
+    """
+    Used in place of HookContainer.end_of_epoch_hook. Every test_interval epochs, the latest models
+    are saved and their weights are sent to a forked evaluation process, and training continues.
+    The accuracies are recorded, and the best models saved, when the evaluation process returns them.
+    At most max_pending evaluations can be queued at once.
+    The best models are saved with write_checkpoint(state_dicts, model_folder, curr_suffix, prev_suffix),
+    which also deletes the previous best models. By default they are written atomically, on the training thread,
+    and then record_checkpoint(model_folder, curr_suffix, prev_suffix) is called.
+    If the evaluation process fails or exits, its error is raised in the training process.
+    """
+    def __init__(self, hooks, tester, dataset_dict, model_folder, test_interval=1, patience=None, test_collate_fn=None, max_pending=2, record_checkpoint=None, write_checkpoint=None):
+        self.hooks = hooks
+        self.tester = tester
+        self.dataset_dict = dataset_dict
+        self.model_folder = model_folder
+        self.test_interval = test_interval
+        self.patience = patience
+        self.test_collate_fn = test_collate_fn
+        self.max_pending = max_pending
+        self.record_checkpoint = record_checkpoint
+        self.write_checkpoint = write_checkpoint if write_checkpoint is not None else self.write_checkpoint_atomically
+        self.process = None
+        self.pending = {}
+        self.best_epoch, _ = self.hooks.get_best_epoch_and_accuracy(self.tester, self.hooks.validation_split_name)
+        c_f.makedir_if_not_there(model_folder)
+
+    def start(self, trainer):
+        ctx = torch.multiprocessing.get_context("fork")
+        self.job_queue = ctx.Queue(maxsize=self.max_pending)
+        self.result_queue = ctx.Queue()
+        self.process = ctx.Process(target=_evaluation_loop,
+                                    args=(self.tester, self.dataset_dict, trainer.models["trunk"], trainer.models["embedder"],
+                                        self.test_collate_fn, self.job_queue, self.result_queue, os.getpid()))
+        self.process.start()
+
+    def __call__(self, trainer):
+        if trainer.epoch % self.test_interval != 0:
+            return True
+        if self.process is None:
+            self.start(trainer)
+        epoch = trainer.epoch
+        self.hooks.save_models(trainer, self.model_folder, epoch, epoch-self.test_interval) # save latest model
+        self.pending[epoch] = snapshot_state_dicts(trainer, self.hooks.saveable_trainer_objects)
+        models = self.pending[epoch]["models"]
+        logging.info("Sending epoch {} to the background evaluator".format(epoch))
+        while len(self.pending) > self.max_pending:
+            self.process_result(trainer, block=True)
+        self.job_queue.put((epoch, models["trunk"], models["embedder"]))
+        self.process_all_available_results(trainer)
+        continue_training = self.hooks.patience_remaining(epoch, self.best_epoch, self.patience)
+        if not continue_training:
+            # a pending evaluation might still produce a new best epoch
+            self.finish(trainer)
+            continue_training = self.hooks.patience_remaining(epoch, self.best_epoch, self.patience)
+        return continue_training
+
+    def write_checkpoint_atomically(self, state_dicts, model_folder, curr_suffix, prev_suffix=None):
+        checkpoint_writer.write_checkpoint(state_dicts, model_folder, curr_suffix, prev_suffix)
+        if self.record_checkpoint is not None:
+            self.record_checkpoint(model_folder, curr_suffix, prev_suffix)
+
+    def process_all_available_results(self, trainer):
+        while len(self.pending) > 0 and self.process_result(trainer, block=False):
+            pass
+
+    def get_result(self, block):
+        if not block:
+            return self.result_queue.get(block=False)
+        while True:
+            # checked before waiting, so that a result put just before the process exited is still received
+            is_alive = self.process.is_alive()
+            try:
+                return self.result_queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if not is_alive:
+                    exitcode = self.process.exitcode
+                    self.shutdown()
+                    raise RuntimeError("The background evaluation process exited unexpectedly with exit code {}".format(exitcode))
+
+    def process_result(self, trainer, block):
+        try:
+            epoch, all_accuracies, error = self.get_result(block)
+        except queue.Empty:
+            return False
+        if error is not None:
+            self.shutdown()
+            raise RuntimeError("The background evaluation of epoch {} failed:\n{}".format(epoch, error))
+        state_dicts = self.pending.pop(epoch)
+        self.tester.all_accuracies = defaultdict(dict, all_accuracies)
+        self.tester.dim_reduced_embeddings = defaultdict(dict)
+        split_name = self.hooks.validation_split_name
+        prev_best_epoch, _ = self.hooks.get_best_epoch_and_accuracy(self.tester, split_name)
+        is_new_best, curr_accuracy, best_epoch, _ = self.hooks.is_new_best_accuracy(self.tester, split_name, epoch)
+        self.hooks.end_of_testing_hook(self.tester)
+        self.hooks.record_keeper.save_records()
+        trainer.step_lr_plateau_schedulers(curr_accuracy)
+        if is_new_best:
+            logging.info("New best accuracy! {}".format(curr_accuracy))
+            prev_suffix = "best%d"%prev_best_epoch if prev_best_epoch is not None else None
+            all_state_dicts = {k: v for obj_dict in state_dicts.values() for k, v in obj_dict.items()}
+            self.write_checkpoint(all_state_dicts, self.model_folder, "best%d"%best_epoch, prev_suffix)
+        self.best_epoch = best_epoch
+        return True
+
+    def finish(self, trainer):
+        while len(self.pending) > 0:
+            self.process_result(trainer, block=True)
+        self.shutdown()
+
+    # Stops the evaluation process without waiting for pending evaluations. Safe to call more than once.
+    def shutdown(self):
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            try:
+                self.job_queue.put(None, timeout=POLL_INTERVAL)
+            except queue.Full:
+                pass
+            self.process.join(timeout=10*POLL_INTERVAL)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+        self.process = None
+        self.pending = {}
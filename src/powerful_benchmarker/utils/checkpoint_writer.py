@@ -0,0 +1,132 @@
+#! /usr/bin/env python3
+
+import torch
+import copy
+import logging
+import os
+import queue
+import threading
+import pytorch_metric_learning.utils.common_functions as pml_cf
+
+
+def get_state_dict(obj):
+    if isinstance(obj, (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel)):
+        obj = obj.module
+    return obj.state_dict()
+
+
+def copy_to_cpu(x):
+    if torch.is_tensor(x):
+        return x.detach().to("cpu", copy=True)
+    if isinstance(x, dict):
+        y = type(x)((k, copy_to_cpu(v)) for k, v in x.items())
+        # module state dicts store their version numbers here
+        if hasattr(x, "_metadata"):
+            y._metadata = copy.deepcopy(x._metadata)
+        return y
+    if isinstance(x, (list, tuple)):
+        return type(x)(copy_to_cpu(v) for v in x)
+    return copy.deepcopy(x)
+
+
+def save_atomically(obj, path):
+    # a dotfile, so that it doesn't match the "trunk_*.pth" pattern used to find checkpoints
+    tmp_path = os.path.join(os.path.dirname(path), ".%s.tmp"%os.path.basename(path))
+    try:
+        with open(tmp_path, "wb") as f:
+            torch.save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+
+
+def delete_checkpoint(model_folder, keys, suffix):
+    for k in keys:
+        model_path = pml_cf.modelpath_creator(model_folder, k, suffix)
+        if os.path.exists(model_path): os.remove(model_path)
+
+
+# prev_suffix can also be a list of the suffixes of checkpoints to delete.
+# If a file can't be saved, the error is raised, and the previous checkpoints aren't deleted.
+def write_checkpoint(state_dicts, model_folder, curr_suffix, prev_suffix=None, save_state_dict=save_atomically, delete_checkpoint=delete_checkpoint):
+    for k, state_dict in state_dicts.items():
+        model_path = pml_cf.modelpath_creator(model_folder, k, curr_suffix)
+        try:
+            save_state_dict(state_dict, model_path)
+        except Exception:
+            logging.error("Could not SAVE %s"%model_path)
+            raise
+    for suffix in (prev_suffix if isinstance(prev_suffix, list) else [prev_suffix]):
+        if suffix is not None and suffix != curr_suffix:
+            delete_checkpoint(model_folder, list(state_dicts.keys()), suffix)
+
+
+class CheckpointWriter:
+    """
+    Used in place of HookContainer.save_models. The state dicts are copied to CPU memory
+    on the training thread, and written to disk by a background thread. Each file is written
+    to a temporary file and then renamed, so a checkpoint file is never partially written.
+    The files have the same names and contents as the ones saved by HookContainer.save_models.
+    At most max_pending checkpoints can be waiting to be written. save_models blocks until there is room.
+    record_checkpoint(model_folder, curr_suffix, prev_suffix) is called after a checkpoint is written.
+    If a checkpoint can't be written, it isn't recorded, and the error is raised by the next call to
+    save_models, flush or close.
+    save_state_dict(state_dict, path) and delete_checkpoint(model_folder, keys, suffix) can be replaced,
+    for example by the methods of a TensorStore.
+    """
+    def __init__(self, max_pending=2, record_checkpoint=None, save_state_dict=save_atomically, delete_checkpoint=delete_checkpoint):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.record_checkpoint = record_checkpoint
+        self.save_state_dict = save_state_dict
+        self.delete_checkpoint = delete_checkpoint
+        self.error = None
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def save_models(self, trainer, saveable_trainer_objects, model_folder, curr_suffix, prev_suffix=None):
+        state_dicts = {}
+        for x in saveable_trainer_objects:
+            for k, v in getattr(trainer, x, {}).items():
+                state_dicts[k] = get_state_dict(v)
+        self.save_state_dicts(state_dicts, model_folder, curr_suffix, prev_suffix)
+
+    # state_dicts is {name: state dict}, like {"trunk": ..., "embedder": ...}
+    def save_state_dicts(self, state_dicts, model_folder, curr_suffix, prev_suffix=None):
+        self.raise_error_if_any()
+        state_dicts = {k: copy_to_cpu(v) for k, v in state_dicts.items()}
+        self.queue.put((state_dicts, model_folder, curr_suffix, prev_suffix))
+
+    def write_loop(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                self.write(*job)
+            except Exception as e:
+                logging.error("Could not save checkpoint: %s"%repr(e))
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def write(self, state_dicts, model_folder, curr_suffix, prev_suffix):
+        write_checkpoint(state_dicts, model_folder, curr_suffix, prev_suffix, self.save_state_dict, self.delete_checkpoint)
+        if self.record_checkpoint is not None:
+            self.record_checkpoint(model_folder, curr_suffix, prev_suffix)
+
+    def raise_error_if_any(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def flush(self):
+        self.queue.join()
+        self.raise_error_if_any()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error_if_any()
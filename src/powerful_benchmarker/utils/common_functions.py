@@ -18,8 +18,13 @@ import datetime
 import sqlite3
 import tqdm
 import tarfile, zipfile
+import hashlib
+import shutil
+from . import experiment_manifest
 
 CONFIG_DIFF_BASE_FOLDER_NAME = "resume_training_config_diffs_"
+MERGED_CONFIG_SNAPSHOTS_FOLDER_NAME = "merged_config_snapshots"
+REPRODUCED_CONFIG_SNAPSHOTS_FOLDER_NAME = "reproduced_config_snapshots"
 
 
 def move_optimizer_to_gpu(optimizer, device):
@@ -48,28 +53,38 @@ def write_yaml(fname, input_dict, open_as):
         yaml.dump(input_dict, outfile, default_flow_style=False, sort_keys=False)
 
 
-def latest_sub_experiment_epochs(sub_experiment_dir_dict):
+def latest_sub_experiment_epochs(sub_experiment_dir_dict, experiment_folder):
     latest_epochs = {}
     for sub_experiment_name, folders in sub_experiment_dir_dict.items():
         model_folder = folders["models"]
-        latest_epochs[sub_experiment_name], _ = pml_cf.latest_version(model_folder)
+        latest_epochs[sub_experiment_name], _ = experiment_manifest.latest_version(experiment_folder, model_folder)
     return latest_epochs
 
 
-def get_sorted_config_diff_folders(config_folder):
+def has_files_in_subfolders(folder):
+    for root, _, files in os.walk(folder):
+        if root != folder and len(files) > 0:
+            return True
+    return False
+
+
+def scan_config_diff_folders(config_folder):
     full_base_path = os.path.join(config_folder, CONFIG_DIFF_BASE_FOLDER_NAME)
-    config_diff_folder_names = glob.glob("%s*"%full_base_path) 
-    latest_epochs = []
-    if len(config_diff_folder_names) > 0:
-        for c in config_diff_folder_names:
-            latest_epochs.append([c]+[int(x) for x in c.replace(full_base_path,"").split('_')])
-        num_training_sets = len(latest_epochs[0])-1
-        latest_epochs = sorted(latest_epochs, key=operator.itemgetter(*list(range(1, num_training_sets+1))))
-        return [x[0] for x in latest_epochs], [x[1:] for x in latest_epochs]
+    return [[os.path.basename(c), [int(x) for x in c.replace(full_base_path,"").split('_')]] for c in glob.glob("%s*"%full_base_path)]
+
+
+# The config diff folders are listed in the experiment manifest, which is next to the config folder.
+# write_manifest should be False for the config folder of another experiment, like the one being reproduced.
+def get_sorted_config_diff_folders(config_folder, write_manifest=True):
+    experiment_folder = os.path.dirname(os.path.normpath(config_folder))
+    config_diffs = experiment_manifest.get_config_diffs(experiment_folder, lambda: scan_config_diff_folders(config_folder), write_manifest)
+    if len(config_diffs) > 0:
+        config_diffs = sorted(config_diffs, key=operator.itemgetter(1))
+        return [os.path.join(config_folder, x[0]) for x in config_diffs], [x[1] for x in config_diffs]
     return [], []
 
-def get_all_resume_training_config_diffs(config_folder, split_manager):
-    config_diffs, latest_epochs = get_sorted_config_diff_folders(config_folder)
+def get_all_resume_training_config_diffs(config_folder, split_manager, write_manifest=True):
+    config_diffs, latest_epochs = get_sorted_config_diff_folders(config_folder, write_manifest)
     if len(config_diffs) == 0:
         return {}
     split_scheme_names = [split_manager.get_split_scheme_name(i) for i in range(len(latest_epochs[0]))]
@@ -83,18 +98,16 @@ def save_config_files(config_folder, dict_of_yamls, resume_training, latest_epoc
     makedir_if_not_there(config_folder)
     new_dir = None
     existing_config_diff_folders, _ = get_sorted_config_diff_folders(config_folder)
+    if resume_training:
+        merged_yamls = get_merged_configs(config_folder, list(dict_of_yamls.keys()), existing_config_diff_folders)
+        yaml_diffs = {}
 
     for config_name, config_dict in dict_of_yamls.items():
         fname = os.path.join(config_folder, '%s.yaml'%config_name)
         if not resume_training:
             write_yaml(fname, config_dict, 'w')
         else:
-            curr_yaml = load_yaml(fname)
-            for config_diff_folder in existing_config_diff_folders:
-                config_diff = os.path.join(config_diff_folder, '%s.yaml'%config_name)
-                if os.path.isfile(config_diff):
-                    curr_yaml = emag_utils.merge_two_dicts(curr_yaml, load_yaml(config_diff), max_merge_depth=float('inf'))
-
+            curr_yaml = merged_yamls[config_name]
             yaml_diff = {}
             for k, v in config_dict.items():
                 if (k not in curr_yaml) or (v != curr_yaml[k]):
@@ -105,6 +118,149 @@ def save_config_files(config_folder, dict_of_yamls, resume_training, latest_epoc
                 makedir_if_not_there(new_dir)
                 fname = os.path.join(new_dir, '%s.yaml' %config_name)
                 write_yaml(fname, yaml_diff, 'a')
+                yaml_diffs[config_name] = yaml_diff
+
+    if new_dir is not None:
+        experiment_manifest.record_config_diff(os.path.dirname(os.path.normpath(config_folder)), os.path.basename(new_dir), latest_epochs)
+        # if new_dir already existed, it was appended to, and its snapshot will be rebuilt when it's needed
+        if new_dir not in existing_config_diff_folders:
+            merged_yamls = {k: emag_utils.merge_two_dicts(v, yaml_diffs.get(k, {}), max_merge_depth=0) for k, v in merged_yamls.items()}
+            save_merged_config_snapshot(config_folder, existing_config_diff_folders + [new_dir], merged_yamls)
+
+
+# A snapshot stores the saved configs merged with the first n config diffs, in merged_config_snapshots/v<n>.
+# The config diffs remain the source of truth. A snapshot is only used if its source yaml files are unchanged.
+# snapshot_info.yaml records the size, mtime and hash of the source files of each folder, so only the folders
+# whose files have a different size or mtime are read again. The next snapshot reuses these records.
+def get_merged_config_snapshot_folder(config_folder, config_diff_folders, snapshots_folder=None):
+    if snapshots_folder is None:
+        snapshots_folder = os.path.join(config_folder, MERGED_CONFIG_SNAPSHOTS_FOLDER_NAME)
+    return os.path.join(snapshots_folder, "v%d"%len(config_diff_folders))
+
+
+def get_snapshot_info_path(config_folder, config_diff_folders, snapshots_folder=None):
+    return os.path.join(get_merged_config_snapshot_folder(config_folder, config_diff_folders, snapshots_folder), "snapshot_info.yaml")
+
+
+def get_config_file_stats(folder, config_names):
+    stats = []
+    for config_name in sorted(config_names):
+        fname = os.path.join(folder, '%s.yaml'%config_name)
+        if os.path.isfile(fname):
+            s = os.stat(fname)
+            stats.append([config_name, s.st_size, s.st_mtime_ns])
+    return stats
+
+
+def get_config_files_hash(config_folder, folder, config_names):
+    h = hashlib.md5()
+    for config_name in sorted(config_names):
+        fname = os.path.join(folder, '%s.yaml'%config_name)
+        if os.path.isfile(fname):
+            h.update(os.path.relpath(fname, config_folder).encode("utf-8"))
+            with open(fname, 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+# Returns a {"folder", "stats", "hash"} dict for the config folder and each config diff folder.
+# The hash is copied from cached_sources if the stats of the folder are unchanged.
+def get_config_sources(config_folder, config_names, config_diff_folders, cached_sources=()):
+    cached_sources = {x["folder"]: x for x in cached_sources}
+    sources = []
+    for folder in [config_folder] + list(config_diff_folders):
+        name = os.path.relpath(folder, config_folder)
+        stats = get_config_file_stats(folder, config_names)
+        cached = cached_sources.get(name)
+        if cached is not None and cached["stats"] == stats:
+            folder_hash = cached["hash"]
+        else:
+            folder_hash = get_config_files_hash(config_folder, folder, config_names)
+        sources.append({"folder": name, "stats": stats, "hash": folder_hash})
+    return sources
+
+
+def load_snapshot_info(config_folder, config_diff_folders, snapshots_folder=None):
+    info_path = get_snapshot_info_path(config_folder, config_diff_folders, snapshots_folder)
+    if not os.path.isfile(info_path):
+        return None
+    info = load_yaml(info_path)
+    # snapshots made before the source records existed are rebuilt
+    return info if isinstance(info, dict) and "sources" in info else None
+
+
+def merged_config_snapshot_is_valid(config_folder, config_names, config_diff_folders, snapshots_folder=None):
+    info = load_snapshot_info(config_folder, config_diff_folders, snapshots_folder)
+    if info is None or not set(config_names).issubset(info["config_names"]):
+        return False
+    sources = get_config_sources(config_folder, info["config_names"], config_diff_folders, info["sources"])
+    if [x["hash"] for x in sources] != [x["hash"] for x in info["sources"]]:
+        logging.info("The merged config snapshot %s is out of date"%get_merged_config_snapshot_folder(config_folder, config_diff_folders, snapshots_folder))
+        return False
+    return True
+
+
+def save_merged_config_snapshot(config_folder, config_diff_folders, merged_yamls, snapshots_folder=None):
+    snapshot_folder = get_merged_config_snapshot_folder(config_folder, config_diff_folders, snapshots_folder)
+    tmp_folder = "%s.tmp%d"%(snapshot_folder, os.getpid())
+    try:
+        # the records of the previous snapshot cover all but the last config diff folder
+        cached_sources = []
+        for x in [config_diff_folders[:-1], config_diff_folders]:
+            prev_info = load_snapshot_info(config_folder, x, snapshots_folder) if len(x) > 0 else None
+            if prev_info is not None and set(merged_yamls.keys()) == set(prev_info["config_names"]):
+                cached_sources.extend(prev_info["sources"])
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        makedir_if_not_there(tmp_folder)
+        for config_name, config_dict in merged_yamls.items():
+            write_yaml(os.path.join(tmp_folder, '%s.yaml'%config_name), config_dict, 'w')
+        info = {"sources": get_config_sources(config_folder, merged_yamls.keys(), config_diff_folders, cached_sources),
+                "config_diff_folders": [os.path.basename(x) for x in config_diff_folders],
+                "config_names": sorted(merged_yamls.keys())}
+        write_yaml(os.path.join(tmp_folder, "snapshot_info.yaml"), info, 'w')
+        shutil.rmtree(snapshot_folder, ignore_errors=True)
+        os.replace(tmp_folder, snapshot_folder)
+        return True
+    except OSError as e:
+        logging.warning("Could not save the merged config snapshot %s: %s"%(snapshot_folder, e))
+        return False
+
+
+def merge_config_diffs(config_folder, config_names, config_diff_folders):
+    merged_yamls = {}
+    for config_name in config_names:
+        curr_yaml = load_yaml(os.path.join(config_folder, '%s.yaml'%config_name))
+        for config_diff_folder in config_diff_folders:
+            config_diff = os.path.join(config_diff_folder, '%s.yaml'%config_name)
+            if os.path.isfile(config_diff):
+                curr_yaml = emag_utils.merge_two_dicts(curr_yaml, load_yaml(config_diff), max_merge_depth=0)
+        merged_yamls[config_name] = curr_yaml
+    return merged_yamls
+
+
+def get_merged_configs(config_folder, config_names, config_diff_folders):
+    if len(config_diff_folders) == 0:
+        return merge_config_diffs(config_folder, config_names, config_diff_folders)
+    snapshot_folder = get_merged_config_snapshot_folder(config_folder, config_diff_folders)
+    if merged_config_snapshot_is_valid(config_folder, config_names, config_diff_folders):
+        return {k: load_yaml(os.path.join(snapshot_folder, '%s.yaml'%k)) for k in config_names}
+    merged_yamls = merge_config_diffs(config_folder, config_names, config_diff_folders)
+    save_merged_config_snapshot(config_folder, config_diff_folders, merged_yamls)
+    return merged_yamls
+
+
+# Returns the paths of the merged config snapshot, or if it can't be saved, the saved configs followed by the config diffs.
+# snapshots_folder is where the snapshots are saved, if they shouldn't be saved in the config folder.
+def get_merged_config_paths(config_folder, config_names, config_diff_folders, snapshots_folder=None):
+    folders = [config_folder] + list(config_diff_folders)
+    if len(config_diff_folders) > 0:
+        snapshot_is_valid = merged_config_snapshot_is_valid(config_folder, config_names, config_diff_folders, snapshots_folder)
+        if not snapshot_is_valid:
+            merged_yamls = merge_config_diffs(config_folder, config_names, config_diff_folders)
+            snapshot_is_valid = save_merged_config_snapshot(config_folder, config_diff_folders, merged_yamls, snapshots_folder)
+        if snapshot_is_valid:
+            folders = [get_merged_config_snapshot_folder(config_folder, config_diff_folders, snapshots_folder)]
+    return {k: [os.path.join(f, '%s.yaml'%k) for f in folders if os.path.isfile(os.path.join(f, '%s.yaml'%k))] for k in config_names}
 
 
 def get_last_linear(input_model, return_name=False):
@@ -137,6 +293,14 @@ def try_getting_db_count(record_keeper, table_name):
     return len_of_existing_record
 
 
+def get_state_dict_hash(model):
+    h = hashlib.md5()
+    for k, v in model.state_dict().items():
+        h.update(k.encode("utf-8"))
+        h.update(v.detach().cpu().numpy().tobytes())
+    return h.hexdigest()
+
+
 def get_datetime():
     return datetime.datetime.now()
 
@@ -158,6 +322,11 @@ def if_str_convert_to_singleton_list(input):
         return [input]
     return input
 
+def nested_defaultdict_to_dict(input):
+    if isinstance(input, dict):
+        return {k: nested_defaultdict_to_dict(v) for k, v in input.items()}
+    return input
+
 def first_key_of_dict(input):
     return list(input.keys())[0]
 
@@ -2,6 +2,9 @@
 
 import torch.utils.data
 import numpy as np
+import copy
+import json
+import os
 from . import common_functions as c_f
 from collections import OrderedDict
 
@@ -10,13 +13,38 @@ def get_underlying_dataset(dataset):
         return dataset.dataset
     return dataset
 
+# The params that a dataset was constructed with are stored on it,
+# so that the caches shared by experiments can tell apart datasets of the same class.
+DATASET_PARAMS_ATTR_NAME = "benchmarker_dataset_params"
+
+def set_dataset_params(dataset, dataset_params):
+    setattr(dataset, DATASET_PARAMS_ATTR_NAME, dataset_params)
+
+def get_dataset_params_description(dataset):
+    dataset_params = dict(getattr(get_underlying_dataset(dataset), DATASET_PARAMS_ATTR_NAME, None) or {})
+    if isinstance(dataset_params.get("root"), str):
+        dataset_params["root"] = os.path.abspath(dataset_params["root"])
+    return json.dumps(dataset_params, sort_keys=True, default=str)
+
+def get_dataset_with_transform(dataset, transform):
+    # shallow copy, so the returned dataset shares paths and labels with the input dataset
+    dataset = copy.copy(dataset)
+    dataset.transform = transform
+    return dataset
+
+# returns data and label in the format that the split manager's data_and_label_getter expects
+def format_data_and_label(data, label, data_and_label_getter_keys):
+    if data_and_label_getter_keys is None:
+        return data, label
+    return {data_and_label_getter_keys[0]: data, data_and_label_getter_keys[1]: label}
+
 def get_dataset_attr(dataset, attr_name):
     if isinstance(dataset, torch.utils.data.Subset):
         dataset = get_underlying_dataset(dataset)
     return c_f.get_attr_and_try_as_function(dataset, attr_name)    
 
 def get_dataset_labels(dataset, labels_attr_name):
-    labels = np.array(get_dataset_attr(dataset, labels_attr_name))
+    labels = np.asarray(get_dataset_attr(dataset, labels_attr_name))
     if isinstance(dataset, torch.utils.data.Subset):
         return labels[dataset.indices]
     return labels
@@ -35,23 +63,30 @@ def create_subset(dataset, idx_to_keep):
     return torch.utils.data.Subset(dataset, idx_to_keep)
 
 
-def create_subset_datasets_from_indices(datasets, 
-                                    trainval_subset_idx,
-                                    trainval_global_idx, 
-                                    test_set_idx, 
-                                    split_scheme_name_func, 
-                                    num_training_sets,
-                                    create_subset_idx_func):
-    split_schemes = OrderedDict()
+def get_split_indices(trainval_subset_idx,
+                    trainval_global_idx, 
+                    test_set_idx, 
+                    split_scheme_name_func, 
+                    num_training_sets):
+    split_indices = OrderedDict()
     for i, (train_idx, val_idx) in enumerate(trainval_subset_idx):
-        if i < num_training_sets:
-            split_dict = {"train": trainval_global_idx[train_idx], "val": trainval_global_idx[val_idx], "test": test_set_idx}
-            name = split_scheme_name_func(i)
-            split_schemes[name] = OrderedDict()
-            for transform_type in datasets.keys():
-                split_schemes[name][transform_type] = OrderedDict()
-                for k, v in split_dict.items():
-                    curr_dataset = datasets[transform_type][k]
-                    subset_idx = create_subset_idx_func(curr_dataset, v)
-                    split_schemes[name][transform_type][k] = create_subset(curr_dataset, subset_idx)
-    return split_schemes
\ No newline at end of file
+        if i >= num_training_sets:
+            break
+        name = split_scheme_name_func(i)
+        split_indices[name] = OrderedDict([("train", trainval_global_idx[train_idx]), ("val", trainval_global_idx[val_idx]), ("test", test_set_idx)])
+    return split_indices
+
+
+# split_indices is a two-level dictionary: {split_scheme_name: {split_name: indices}}
+# create_subset_idx_func converts the indices into subset indices of each dataset
+def create_subset_datasets_from_split_indices(datasets, split_indices, create_subset_idx_func):
+    split_schemes = OrderedDict()
+    for name, split_dict in split_indices.items():
+        split_schemes[name] = OrderedDict()
+        for transform_type in datasets.keys():
+            split_schemes[name][transform_type] = OrderedDict()
+            for k, v in split_dict.items():
+                curr_dataset = datasets[transform_type][k]
+                subset_idx = create_subset_idx_func(curr_dataset, v)
+                split_schemes[name][transform_type][k] = create_subset(curr_dataset, subset_idx)
+    return split_schemes
@@ -0,0 +1,133 @@
+#! /usr/bin/env python3
+
+import torch
+import numpy as np
+import json
+import logging
+import os
+from . import common_functions as c_f, dataset_utils as d_u
+
+
+EMBEDDING_DTYPES = ["float32", "float16", "int8"]
+
+
+def get_filename(tester, epoch, split_name):
+    return "{}_epoch{}_{}.emb".format(tester.description_suffixes("embeddings"), epoch, split_name)
+
+
+# int8 quantization is symmetric and per dimension: embeddings[:, d] ~= quantized[:, d] * scale[d]
+def quantize(embeddings, dtype):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if dtype == "float32":
+        return embeddings, None
+    if dtype == "float16":
+        return embeddings.astype(np.float16), None
+    if dtype == "int8":
+        # np.max can't reduce an empty array
+        scale = np.max(np.abs(embeddings), axis=0) / 127 if len(embeddings) > 0 else np.ones(embeddings.shape[1:], dtype=np.float32)
+        scale[scale == 0] = 1
+        return np.clip(np.round(embeddings / scale), -127, 127).astype(np.int8), scale.astype(np.float32)
+    raise ValueError("dtype must be one of {}".format(EMBEDDING_DTYPES))
+
+
+def dequantize(embeddings, scale=None):
+    embeddings = embeddings.astype(np.float32)
+    if scale is not None:
+        embeddings *= np.asarray(scale, dtype=np.float32)
+    return embeddings
+
+
+def get_data_offset(header_length):
+    # the arrays start at a 64-byte boundary after the header
+    return 8 + header_length + (-(8 + header_length) % 64)
+
+
+def save_embeddings(folder, filename, embeddings, labels, dtype="float32", extra_header=None):
+    """
+    The file starts with the length of a JSON header (uint64), followed by the header,
+    which has the dtype, shape, and byte offset (relative to the start of the arrays) of the
+    embeddings and labels, and the per-dimension scale of int8 embeddings.
+    The arrays follow the header, so they can be read as memory maps.
+    """
+    c_f.makedir_if_not_there(folder)
+    quantized, scale = quantize(embeddings, dtype)
+    labels = np.ascontiguousarray(labels)
+    header = {"embeddings": {"dtype": quantized.dtype.str, "shape": quantized.shape, "offset": 0},
+            "labels": {"dtype": labels.dtype.str, "shape": labels.shape, "offset": quantized.nbytes},
+            "scale": None if scale is None else scale.tolist()}
+    header.update(extra_header or {})
+    header_bytes = json.dumps(header).encode("utf-8")
+    path = os.path.join(folder, filename)
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, "wb") as f:
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        f.write(b" " * (get_data_offset(len(header_bytes)) - 8 - len(header_bytes)))
+        np.ascontiguousarray(quantized).tofile(f)
+        labels.tofile(f)
+    os.replace(tmp_path, path)
+
+
+def read_embeddings(path):
+    """
+    Returns the header, and read-only memory maps of the stored embeddings (not dequantized) and labels.
+    """
+    with open(path, "rb") as f:
+        header_length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    data_offset = get_data_offset(header_length)
+    arrays = []
+    for k in ["embeddings", "labels"]:
+        shape = tuple(header[k]["shape"])
+        if np.prod(shape) == 0:
+            arrays.append(np.zeros(shape, dtype=header[k]["dtype"]))
+        else:
+            arrays.append(np.memmap(path, dtype=header[k]["dtype"], mode="r", offset=data_offset+header[k]["offset"], shape=shape))
+    return header, arrays[0], arrays[1]
+
+
+# Returns None if the file doesn't exist, or if its header doesn't have the values in expected_header.
+def load_embeddings(folder, filename, expected_header=None):
+    path = os.path.join(folder, filename)
+    if not os.path.isfile(path):
+        return None
+    header, embeddings, labels = read_embeddings(path)
+    for k, v in (expected_header or {}).items():
+        if header.get(k) != v:
+            logging.info("{} was saved with a different {}, and will not be used".format(path, k))
+            return None
+    if header["scale"] is not None:
+        embeddings = dequantize(embeddings, header["scale"])
+    return embeddings, labels
+
+
+# Returns, for each split, how much each accuracy changes when the embeddings are stored as dtype instead of float32.
+def get_accuracy_deltas(tester, dtype):
+    stored = {k: (dequantize(*quantize(e, dtype)), L) for k, (e, L) in tester.embeddings_and_labels.items()}
+    deltas = {}
+    for split_name, accuracies in tester.all_accuracies.items():
+        stored_accuracies = {}
+        tester.do_knn_and_accuracies(stored_accuracies, stored, split_name)
+        deltas[split_name] = {k: float(v - accuracies[k]) for k, v in stored_accuracies.items() if k in accuracies}
+        logging.info("Accuracy change from storing {} embeddings as {}: {}".format(split_name, dtype, deltas[split_name]))
+    return deltas
+
+
+# computed in float32, because the norms of float16 embeddings can overflow
+def l2_normalize(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+class ArrayDataset(torch.utils.data.Dataset):
+    def __init__(self, data, labels, data_and_label_getter_keys=None):
+        self.data = data
+        self.labels = labels
+        self.data_and_label_getter_keys = data_and_label_getter_keys
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, idx):
+        return d_u.format_data_and_label(torch.from_numpy(self.data[idx]), self.labels[idx], self.data_and_label_getter_keys)
@@ -0,0 +1,109 @@
+#! /usr/bin/env python3
+
+import torch
+import numpy as np
+import hashlib
+import logging
+import os
+import tqdm
+import pytorch_metric_learning.utils.common_functions as pml_cf
+from . import common_functions as c_f, dataset_utils as d_u
+
+
+# Splits a composed transform into the part whose output is cached, and the part that is applied when reading.
+# Everything up to and including ToTensor is cached as uint8, which is exact because ToTensor outputs x/255.
+# If there is no ToTensor, the whole transform is cached as float16.
+def split_transform(transform):
+    transforms = getattr(transform, "transforms", [])
+    for i, t in enumerate(transforms):
+        if type(t).__name__ == "ToTensor":
+            after = transforms[i+1:]
+            return type(transform)(transforms[:i+1]), type(transform)(after) if len(after) > 0 else None, np.uint8
+    return transform, None, np.float16
+
+
+def get_tensors_key(cached_transform, dataset, labels):
+    h = hashlib.md5()
+    underlying = d_u.get_underlying_dataset(dataset)
+    for x in [repr(cached_transform), type(underlying).__name__, d_u.get_dataset_params_description(underlying), str(len(underlying))]:
+        h.update(x.encode("utf-8"))
+    h.update(np.ascontiguousarray(getattr(dataset, "indices", [])).tobytes())
+    h.update(np.ascontiguousarray(labels).tobytes())
+    return h.hexdigest()
+
+
+def compute_tensors(dataset, output_path, dtype, batch_size, num_workers, collate_fn, data_and_label_getter):
+    logging.info("Caching transformed eval data for {} samples in {}".format(len(dataset), output_path))
+    dataloader = pml_cf.get_eval_dataloader(dataset, batch_size, num_workers, collate_fn)
+    tmp_path = "{}.tmp.npy".format(output_path)
+    tensors, s = None, 0
+    for data in tqdm.tqdm(dataloader):
+        img, _ = data_and_label_getter(data)
+        img = img.mul(255).round() if dtype == np.uint8 else img
+        img = img.numpy().astype(dtype)
+        if tensors is None:
+            tensors = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=(len(dataset),)+img.shape[1:])
+        elif img.shape[1:] != tensors.shape[1:]:
+            raise ValueError("The eval transform must output tensors of the same shape, in order to cache them")
+        tensors[s:s+len(img)] = img
+        s += len(img)
+    tensors.flush()
+    del tensors
+    os.replace(tmp_path, output_path)
+
+
+class EvalTensorDataset(torch.utils.data.Dataset):
+    """
+    Returns cached transformed images. Attributes that are not
+    defined here are looked up on source_dataset.
+    """
+    def __init__(self, source_dataset, tensors_path, labels, remaining_transform=None, data_and_label_getter_keys=None):
+        self.source_dataset = source_dataset
+        self.tensors_path = tensors_path
+        self.tensor_labels = labels
+        self.remaining_transform = remaining_transform
+        self.data_and_label_getter_keys = data_and_label_getter_keys
+        self.tensors = None
+
+    def __len__(self):
+        return len(self.tensor_labels)
+
+    def __getitem__(self, idx):
+        # opened lazily so that each dataloader worker maps the same file instead of copying it
+        if self.tensors is None:
+            self.tensors = np.load(self.tensors_path, mmap_mode="r")
+        data = torch.from_numpy(np.array(self.tensors[idx]))
+        data = data.float().div(255) if data.dtype == torch.uint8 else data.float()
+        if self.remaining_transform is not None:
+            data = self.remaining_transform(data)
+        return d_u.format_data_and_label(data, self.tensor_labels[idx], self.data_and_label_getter_keys)
+
+    def __getattr__(self, name):
+        if name == "source_dataset":
+            raise AttributeError(name)
+        return getattr(self.source_dataset, name)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["tensors"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+def get_eval_tensor_dataset(dataset, cache_folder, split_manager, **compute_kwargs):
+    transform = d_u.get_underlying_dataset(dataset).transform
+    cached_transform, remaining_transform, dtype = split_transform(transform)
+    labels = split_manager.get_labels(dataset=dataset)
+    key = get_tensors_key(cached_transform, dataset, labels)
+    tensors_path = os.path.join(cache_folder, "{}.npy".format(key))
+    if os.path.isfile(tensors_path):
+        logging.info("Loading cached eval data from {}".format(tensors_path))
+    else:
+        c_f.makedir_if_not_there(cache_folder)
+        dataset_to_cache = d_u.get_dataset_with_transform(d_u.get_underlying_dataset(dataset), cached_transform)
+        if isinstance(dataset, torch.utils.data.Subset):
+            dataset_to_cache = torch.utils.data.Subset(dataset_to_cache, dataset.indices)
+        compute_tensors(dataset_to_cache, tensors_path, dtype, data_and_label_getter=split_manager.data_and_label_getter, **compute_kwargs)
+    return EvalTensorDataset(dataset, tensors_path, labels, remaining_transform, split_manager.data_and_label_getter_keys)
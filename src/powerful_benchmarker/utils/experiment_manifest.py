@@ -0,0 +1,223 @@
+#! /usr/bin/env python3
+
+import contextlib
+import glob
+import json
+import logging
+import os
+import threading
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+MANIFEST_FILENAME = "experiment_manifest.json"
+
+# file locks are held per process, so threads of the same process also need a regular lock per lock file
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+# Each experiment folder has a small manifest that records its state, so that resuming
+# and evaluating don't need to scan the experiment folder. It contains:
+#   model_folders: for each model folder (relative to the experiment folder), the suffixes of its saved checkpoints,
+#                  and the latest and best epochs
+#   config_diffs: the resume_training_config_diffs folders, and the epochs they were created at
+#   sub_experiments: the sub experiments of a bayesian optimization experiment
+# A section that is missing is filled in by scanning the folder once, so existing experiments still work.
+# Deleting the manifest is safe, and causes it to be rebuilt.
+
+
+def get_manifest_path(experiment_folder):
+    return os.path.join(experiment_folder, MANIFEST_FILENAME)
+
+
+def load_manifest(experiment_folder):
+    manifest_path = get_manifest_path(experiment_folder)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(experiment_folder, manifest):
+    manifest_path = get_manifest_path(experiment_folder)
+    tmp_path = "%s.tmp%d"%(manifest_path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+@contextlib.contextmanager
+def file_lock(lock_path):
+    with _thread_locks_lock:
+        thread_lock = _thread_locks.setdefault(os.path.abspath(lock_path), threading.Lock())
+    with thread_lock, open(lock_path, "w") as lock_file:
+        lock(lock_file)
+        try:
+            yield
+        finally:
+            unlock(lock_file)
+
+
+def lock(lock_file):
+    if fcntl is not None:
+        fcntl.lockf(lock_file, fcntl.LOCK_EX)
+        return
+    # msvcrt locks the first byte of the file, and gives up after 10 seconds, so it's retried until it succeeds
+    while True:
+        try:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            pass
+
+
+def unlock(lock_file):
+    if fcntl is not None:
+        fcntl.lockf(lock_file, fcntl.LOCK_UN)
+    else:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextlib.contextmanager
+def update_manifest(experiment_folder):
+    """
+    Yields the manifest as a dict, and saves it when the block exits.
+    Concurrent updates, like from split schemes running in parallel, are serialized with a lock file.
+    """
+    os.makedirs(experiment_folder, exist_ok=True)
+    with file_lock("%s.lock"%get_manifest_path(experiment_folder)):
+        manifest = load_manifest(experiment_folder) or {}
+        yield manifest
+        save_manifest(experiment_folder, manifest)
+
+
+def create_manifest(experiment_folder):
+    # only for new experiments, which don't have anything to scan
+    with update_manifest(experiment_folder) as manifest:
+        for k in ["model_folders", "config_diffs", "sub_experiments"]:
+            manifest.setdefault(k, {} if k == "model_folders" else [])
+
+
+def get_or_scan(experiment_folder, get_section, set_section, scan):
+    manifest = load_manifest(experiment_folder)
+    section = get_section(manifest) if manifest is not None else None
+    if section is not None:
+        return section
+    section = scan()
+    try:
+        with update_manifest(experiment_folder) as manifest:
+            if get_section(manifest) is None:
+                set_section(manifest, section)
+            section = get_section(manifest)
+    except OSError as e:
+        logging.warning("Could not update the manifest of {}: {}".format(experiment_folder, e))
+    return section
+
+
+def model_folder_key(experiment_folder, model_folder):
+    return os.path.relpath(model_folder, experiment_folder)
+
+
+def scan_checkpoints(model_folder):
+    # the trunk is saved with every checkpoint, like in pytorch_metric_learning's latest_version
+    prefix = os.path.join(model_folder, "trunk_")
+    return sorted(os.path.splitext(x)[0][len(prefix):] for x in glob.glob("%s*.pth"%prefix))
+
+
+def get_epochs(checkpoints, best):
+    if best:
+        return [int(x[4:]) for x in checkpoints if x.startswith("best") and x[4:].isdigit()]
+    return [int(x) for x in checkpoints if x.isdigit()]
+
+
+def set_checkpoints(entry, checkpoints):
+    entry["checkpoints"] = sorted(set(checkpoints))
+    latest_epochs, best_epochs = get_epochs(checkpoints, best=False), get_epochs(checkpoints, best=True)
+    entry["latest_epoch"] = max(latest_epochs) if len(latest_epochs) > 0 else 0
+    entry["best_epoch"] = max(best_epochs) if len(best_epochs) > 0 else None
+
+
+def get_model_folder_entry(experiment_folder, model_folder):
+    key = model_folder_key(experiment_folder, model_folder)
+    def set_section(manifest, entry):
+        manifest.setdefault("model_folders", {})[key] = entry
+    def scan():
+        entry = {}
+        set_checkpoints(entry, scan_checkpoints(model_folder))
+        return entry
+    return get_or_scan(experiment_folder, lambda m: m.get("model_folders", {}).get(key), set_section, scan)
+
+
+def latest_version(experiment_folder, model_folder, best=False):
+    """
+    Returns the same (epoch, suffix) as pytorch_metric_learning's latest_version,
+    without globbing the model folder.
+    """
+    entry = get_model_folder_entry(experiment_folder, model_folder)
+    epoch = entry["best_epoch"] if best else entry["latest_epoch"]
+    if not epoch:
+        return 0, None
+    return epoch, "best%d"%epoch if best else epoch
+
+
+# prev_suffix can also be a list of the suffixes of deleted checkpoints, and curr_suffix is None if nothing was saved.
+def record_checkpoint(experiment_folder, model_folder, curr_suffix, prev_suffix=None):
+    key = model_folder_key(experiment_folder, model_folder)
+    with update_manifest(experiment_folder) as manifest:
+        model_folders = manifest.setdefault("model_folders", {})
+        if key not in model_folders:
+            # the new checkpoint is already on disk, so it's included in the scan
+            model_folders[key] = {}
+            set_checkpoints(model_folders[key], scan_checkpoints(model_folder))
+        checkpoints = set(model_folders[key]["checkpoints"])
+        for suffix in (prev_suffix if isinstance(prev_suffix, list) else [prev_suffix]):
+            if suffix is not None:
+                checkpoints.discard(str(suffix))
+        if curr_suffix is not None:
+            checkpoints.add(str(curr_suffix))
+        set_checkpoints(model_folders[key], checkpoints)
+
+
+def get_config_diffs(experiment_folder, scan, write_manifest=True):
+    """
+    Returns a list of [config diff folder name, list of epochs].
+    scan is called to find them, if they aren't in the manifest yet.
+    If write_manifest is False, the scan isn't saved, so the experiment folder is only read.
+    """
+    def set_section(manifest, config_diffs):
+        manifest["config_diffs"] = config_diffs
+    if not write_manifest:
+        manifest = load_manifest(experiment_folder)
+        config_diffs = manifest.get("config_diffs") if manifest is not None else None
+        return config_diffs if config_diffs is not None else scan()
+    return get_or_scan(experiment_folder, lambda m: m.get("config_diffs"), set_section, scan)
+
+
+def record_config_diff(experiment_folder, folder_name, epochs):
+    with update_manifest(experiment_folder) as manifest:
+        # if the config diffs haven't been scanned yet, the new folder will be found when they are
+        if "config_diffs" in manifest and folder_name not in [x[0] for x in manifest["config_diffs"]]:
+            manifest["config_diffs"].append([folder_name, list(epochs)])
+
+
+def get_sub_experiments(experiment_folder):
+    # None if the sub experiments weren't recorded from the start
+    manifest = load_manifest(experiment_folder)
+    return manifest.get("sub_experiments") if manifest is not None else None
+
+
+def record_sub_experiment(experiment_folder, sub_experiment_name):
+    with update_manifest(experiment_folder) as manifest:
+        if "sub_experiments" in manifest and sub_experiment_name not in manifest["sub_experiments"]:
+            manifest["sub_experiments"].append(sub_experiment_name)
+
+
+def remove_sub_experiment(experiment_folder, sub_experiment_name):
+    with update_manifest(experiment_folder) as manifest:
+        if sub_experiment_name in manifest.get("sub_experiments", []):
+            manifest["sub_experiments"].remove(sub_experiment_name)
@@ -0,0 +1,58 @@
+#! /usr/bin/env python3
+
+import json
+import logging
+import os
+import numpy as np
+
+
+def get_manifest_path(folder):
+    # next to the folder rather than inside it, so that writing it doesn't change the folder's mtime
+    return "%s_file_manifest.json"%os.path.normpath(folder)
+
+
+def get_directory_mtimes(folder):
+    directory_mtimes = {}
+    for root, _, _ in os.walk(folder):
+        directory_mtimes[os.path.relpath(root, folder)] = os.stat(root).st_mtime_ns
+    return directory_mtimes
+
+
+def directories_are_unchanged(folder, directory_mtimes):
+    try:
+        return all(os.stat(os.path.join(folder, d)).st_mtime_ns == m for d, m in directory_mtimes.items())
+    except FileNotFoundError:
+        return False
+
+
+def load_manifest(folder):
+    """
+    Returns the saved manifest of folder, or None if it doesn't exist, or if
+    any directory in folder has been modified since the manifest was created.
+    """
+    manifest_path = get_manifest_path(folder)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    if not directories_are_unchanged(folder, manifest["directory_mtimes"]):
+        logging.info("%s has changed since %s was created"%(folder, manifest_path))
+        return None
+    return manifest
+
+
+def create_manifest(folder, img_paths, labels, **kwargs):
+    manifest_path = get_manifest_path(folder)
+    logging.info("Creating file manifest %s"%manifest_path)
+    file_stats = [os.stat(x) for x in img_paths]
+    manifest = {"directory_mtimes": get_directory_mtimes(folder),
+                "img_paths": [os.path.relpath(x, folder) for x in img_paths],
+                "labels": np.asarray(labels).tolist(),
+                "file_sizes": [x.st_size for x in file_stats],
+                "file_mtimes": [x.st_mtime_ns for x in file_stats],
+                **kwargs}
+    tmp_manifest_path = "%s.tmp"%manifest_path
+    with open(tmp_manifest_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_manifest_path, manifest_path)
+    return manifest
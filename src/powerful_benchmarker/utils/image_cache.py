@@ -0,0 +1,94 @@
+#! /usr/bin/env python3
+
+import numpy as np
+from PIL import Image
+from multiprocessing.pool import ThreadPool
+import hashlib
+import logging
+import os
+import tqdm
+from . import common_functions as c_f
+
+
+def resize_shorter_side(img, size):
+    # same output size as torchvision's Resize(size) when size is an int
+    w, h = img.size
+    if (w <= h and w == size) or (h <= w and h == size):
+        return img
+    if w < h:
+        ow, oh = size, int(size * h / w)
+    else:
+        ow, oh = int(size * w / h), size
+    return img.resize((ow, oh), Image.BILINEAR)
+
+
+def get_ids_hash(image_ids):
+    return hashlib.md5("\n".join(image_ids).encode("utf-8")).hexdigest()
+
+
+class ResizedImageCache:
+    """
+    Stores every image of a dataset as a uint8 array whose shorter side is
+    resized to "size". All images are concatenated in one memory-mapped file,
+    and an index holds the offset and (height, width) of each image.
+    """
+    def __init__(self, folder, size, image_ids, load_image_func, num_workers=None, chunksize=16):
+        self.folder = folder
+        self.size = int(size)
+        self.data_path = os.path.join(folder, "resized_%d.bin"%self.size)
+        self.index_path = os.path.join(folder, "resized_%d_index.npz"%self.size)
+        self.ids_hash = get_ids_hash(image_ids)
+        self.num_images = len(image_ids)
+        self.num_workers = os.cpu_count() if num_workers is None else num_workers
+        self.chunksize = chunksize
+        if not self.index_is_valid():
+            self.build(load_image_func)
+        self.load_index()
+        self.data = None
+
+    def index_is_valid(self):
+        if not (os.path.isfile(self.index_path) and os.path.isfile(self.data_path)):
+            return False
+        index = np.load(self.index_path)
+        is_valid = str(index["ids_hash"]) == self.ids_hash and int(index["size"]) == self.size
+        if not is_valid:
+            logging.info("Image cache at %s is out of date and will be rebuilt"%self.data_path)
+        return is_valid
+
+    def load_index(self):
+        index = np.load(self.index_path)
+        self.offsets, self.shapes = index["offsets"], index["shapes"]
+
+    def build(self, load_image_func):
+        logging.info("Building image cache with shorter side %d at %s"%(self.size, self.data_path))
+        c_f.makedir_if_not_there(self.folder)
+        offsets = np.zeros(self.num_images+1, dtype=np.int64)
+        shapes = np.zeros((self.num_images, 2), dtype=np.int32)
+        load_and_resize = lambda idx: np.asarray(resize_shorter_side(load_image_func(idx), self.size), dtype=np.uint8)
+        tmp_data_path = "%s.tmp"%self.data_path
+        # imap yields the images in order as they are resized, so they are written out instead of all being kept in memory
+        with open(tmp_data_path, "wb") as f, ThreadPool(self.num_workers) as pool:
+            for i, img in enumerate(tqdm.tqdm(pool.imap(load_and_resize, range(self.num_images), chunksize=self.chunksize), total=self.num_images)):
+                f.write(img.tobytes())
+                shapes[i] = img.shape[:2]
+                offsets[i+1] = offsets[i] + img.size
+        os.replace(tmp_data_path, self.data_path)
+        tmp_index_path = "%s.tmp.npz"%self.index_path
+        np.savez(tmp_index_path, offsets=offsets, shapes=shapes, ids_hash=self.ids_hash, size=self.size)
+        os.replace(tmp_index_path, self.index_path)
+
+    def __len__(self):
+        return self.num_images
+
+    def __getitem__(self, idx):
+        # opened lazily so that each dataloader worker maps the same file instead of copying it
+        if self.data is None:
+            self.data = np.memmap(self.data_path, dtype=np.uint8, mode="r")
+        s, e = self.offsets[idx], self.offsets[idx+1]
+        h, w = self.shapes[idx]
+        return Image.fromarray(np.asarray(self.data[s:e]).reshape(h, w, 3))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["data"] = None
+        return state
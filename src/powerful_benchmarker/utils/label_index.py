@@ -0,0 +1,29 @@
+#! /usr/bin/env python3
+
+import numpy as np
+from . import dataset_utils as d_u
+
+
+class LabelIndex:
+    """
+    Holds the labels of one dataset, and the unique labels of each hierarchy level,
+    which are computed the first time they are needed.
+    """
+    def __init__(self, labels):
+        self.labels = np.asarray(labels)
+        self.unique_labels = {}
+
+    def get_labels(self, hierarchy_level=None):
+        if hierarchy_level is None:
+            # a read-only view, so that callers can't change the labels that are shared with other callers
+            labels = self.labels.view()
+            labels.flags.writeable = False
+            return labels
+        return d_u.get_labels_by_hierarchy(self.labels, hierarchy_level)
+
+    def get_unique_labels(self, hierarchy_level):
+        if hierarchy_level not in self.unique_labels:
+            unique_labels = np.unique(d_u.get_labels_by_hierarchy(self.labels, hierarchy_level))
+            unique_labels.flags.writeable = False
+            self.unique_labels[hierarchy_level] = unique_labels
+        return self.unique_labels[hierarchy_level]
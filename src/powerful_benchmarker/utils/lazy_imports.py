@@ -0,0 +1,38 @@
+#! /usr/bin/env python3
+
+import importlib
+import importlib.util
+import types
+from . import startup_profile
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stands in for a module that is imported the first time one of its attributes is accessed.
+    It can be registered with PytorchGetter like a regular module.
+    If attributes is given, only those attributes can be accessed,
+    which is how a single class of the module is registered.
+    """
+    def __init__(self, name, package=None, attributes=None):
+        super().__init__(importlib.util.resolve_name(name, package))
+        self._lazy_attributes = attributes
+        self._lazy_module = None
+
+    def _load(self):
+        if self._lazy_module is None:
+            with startup_profile.section("imports"):
+                self._lazy_module = importlib.import_module(self.__name__)
+        return self._lazy_module
+
+    def __getattr__(self, name):
+        if name.startswith("_lazy_") or (self._lazy_attributes is not None and name not in self._lazy_attributes):
+            raise AttributeError("{} has no attribute {}".format(self.__name__, name))
+        return getattr(self._load(), name)
+
+    def __dir__(self):
+        if self._lazy_attributes is not None:
+            return list(self._lazy_attributes)
+        return dir(self._load())
+
+    def __repr__(self):
+        return "<lazy module '{}'>".format(self.__name__)
@@ -0,0 +1,40 @@
+#! /usr/bin/env python3
+
+import torch
+import numpy as np
+import logging
+import tqdm
+import pytorch_metric_learning.utils.common_functions as pml_cf
+from . import common_functions as c_f
+
+
+def group_by_trunk(list_of_models):
+    # models with identical trunk weights (e.g. the untrained trunk, and the untrained trunk + embedder)
+    # share one trunk forward pass
+    trunk_groups = {}
+    for i, (trunk, _) in enumerate(list_of_models):
+        trunk_groups.setdefault(c_f.get_state_dict_hash(trunk), []).append(i)
+    return list(trunk_groups.values())
+
+
+def compute_embeddings_for_models(dataset, list_of_models, use_trunk_output, batch_size, num_workers, collate_fn, data_and_label_getter, device):
+    """
+    Runs every (trunk, embedder) pair in list_of_models on each batch of dataset,
+    so that each batch is loaded and transformed only once.
+    Returns a list of embeddings (one per model) and the labels as returned by the dataset.
+    """
+    logging.info("Computing embeddings of {} models in one pass over {} samples".format(len(list_of_models), len(dataset)))
+    trunk_groups = group_by_trunk(list_of_models)
+    dataloader = pml_cf.get_eval_dataloader(dataset, batch_size, num_workers, collate_fn)
+    all_embeddings, all_labels = [[] for _ in list_of_models], []
+    with torch.no_grad():
+        for data in tqdm.tqdm(dataloader):
+            img, label = data_and_label_getter(data)
+            img = img.to(device)
+            for group in trunk_groups:
+                trunk_output = list_of_models[group[0]][0](img)
+                for i in group:
+                    embeddings = trunk_output if use_trunk_output else list_of_models[i][1](trunk_output)
+                    all_embeddings[i].append(embeddings.cpu().numpy())
+            all_labels.append(np.asarray(label))
+    return [np.concatenate(x, axis=0) for x in all_embeddings], np.concatenate(all_labels, axis=0)
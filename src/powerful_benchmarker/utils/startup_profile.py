@@ -0,0 +1,43 @@
+#! /usr/bin/env python3
+
+import collections
+import contextlib
+import logging
+import time
+
+# Seconds spent in each section. Time spent in a nested section is only counted for the inner section.
+_timings = collections.OrderedDict()
+_nested_time_stack = []
+_start_time = time.perf_counter()
+_reported = False
+
+
+@contextlib.contextmanager
+def section(name):
+    start = time.perf_counter()
+    _nested_time_stack.append(0)
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        nested_time = _nested_time_stack.pop()
+        _timings[name] = _timings.get(name, 0) + elapsed - nested_time
+        if len(_nested_time_stack) > 0:
+            _nested_time_stack[-1] += elapsed
+
+
+def get_timings():
+    total = time.perf_counter() - _start_time
+    timings = collections.OrderedDict(_timings)
+    timings["other"] = max(0, total - sum(timings.values()))
+    timings["total"] = total
+    return timings
+
+
+def report(only_once=True):
+    global _reported
+    if only_once and _reported:
+        return
+    _reported = True
+    lines = ["{:<24}{:>9.3f}s".format(k, v) for k, v in get_timings().items()]
+    logging.info("Startup time profile:\n{}".format("\n".join(lines)))
@@ -0,0 +1,104 @@
+#! /usr/bin/env python3
+
+import torch
+import numpy as np
+import hashlib
+import json
+import logging
+import os
+import tqdm
+from collections import defaultdict
+import pytorch_metric_learning.utils.common_functions as pml_cf
+from . import common_functions as c_f, dataset_utils as d_u, embedding_store
+
+
+def get_key(trunk, embedder, dataset, tester):
+    h = hashlib.md5()
+    underlying = d_u.get_underlying_dataset(dataset)
+    for x in [c_f.get_state_dict_hash(trunk), c_f.get_state_dict_hash(embedder), tester.description_suffixes("embeddings"),
+            type(underlying).__name__, str(len(dataset)), repr(getattr(underlying, "transform", None))]:
+        h.update(x.encode("utf-8"))
+    h.update(np.ascontiguousarray(getattr(dataset, "indices", [])).tobytes())
+    return h.hexdigest()
+
+
+def get_paths(folder, name):
+    return [os.path.join(folder, "{}{}".format(name, x)) for x in ["_embeddings.npy", "_labels.npy", "_progress.json"]]
+
+
+def load_progress(embeddings_path, labels_path, progress_path, key):
+    if all(os.path.isfile(x) for x in [embeddings_path, labels_path, progress_path]):
+        with open(progress_path, "r") as f:
+            progress = json.load(f)
+        if progress["key"] == key:
+            return progress
+    return None
+
+
+def save_progress(progress_path, progress):
+    tmp_path = "{}.tmp".format(progress_path)
+    with open(tmp_path, "w") as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, progress_path)
+
+
+def compute_embeddings(tester, trunk, embedder, dataset, folder, name, key, collate_fn, chunk_size=16384):
+    """
+    Computes the embeddings and labels of dataset the same way as tester.get_all_embeddings,
+    and writes them to memory-mapped files, chunk_size samples at a time.
+    The number of completed samples is saved after each chunk,
+    so an interrupted evaluation resumes from the last completed chunk.
+    Returns read-only memory maps of the embeddings and labels.
+    """
+    if len(dataset) == 0:
+        # there is nothing to write, and the embedding size isn't known without a batch
+        logging.info("{} is empty, so there are no embeddings to compute".format(name))
+        return np.zeros((0, 0), dtype=np.float32), np.zeros((0, 1), dtype=np.float32)
+    embeddings_path, labels_path, progress_path = get_paths(folder, name)
+    progress = load_progress(embeddings_path, labels_path, progress_path, key)
+    if progress is None:
+        progress = {"key": key, "num_completed": 0}
+    elif progress["num_completed"] > 0:
+        logging.info("Resuming embedding computation for {} at sample {}/{}".format(name, progress["num_completed"], len(dataset)))
+    c_f.makedir_if_not_there(folder)
+    trunk.eval()
+    embedder.eval()
+    embeddings, labels = None, None
+    for s in range(progress["num_completed"], len(dataset), chunk_size):
+        chunk = torch.utils.data.Subset(dataset, np.arange(s, min(s+chunk_size, len(dataset))))
+        dataloader = pml_cf.get_eval_dataloader(chunk, tester.batch_size, tester.dataloader_num_workers, collate_fn)
+        logging.info("Computing embeddings {}-{} of {} for {}".format(s, s+len(chunk), len(dataset), name))
+        with torch.no_grad():
+            for data in tqdm.tqdm(dataloader):
+                img, label = tester.data_and_label_getter(data)
+                label = pml_cf.process_label(label, "all", tester.label_mapper)
+                if label.dim() == 1:
+                    label = label.unsqueeze(1)
+                q = tester.get_embeddings_for_eval(trunk, embedder, img).cpu().numpy()
+                if tester.normalize_embeddings:
+                    q = embedding_store.l2_normalize(q)
+                if embeddings is None:
+                    mode = "r+" if s > 0 else "w+"
+                    embeddings = np.lib.format.open_memmap(embeddings_path, mode=mode, dtype=np.float32, shape=(len(dataset), q.shape[1]))
+                    labels = np.lib.format.open_memmap(labels_path, mode=mode, dtype=np.float32, shape=(len(dataset), label.size(1)))
+                embeddings[s:s+len(q)] = q
+                labels[s:s+len(q)] = label.cpu().numpy()
+                s += len(q)
+        embeddings.flush()
+        labels.flush()
+        progress["num_completed"] = s
+        save_progress(progress_path, progress)
+    del embeddings, labels
+    return np.load(embeddings_path, mmap_mode="r"), np.load(labels_path, mmap_mode="r")
+
+
+def test_with_embeddings(tester, embeddings_and_labels, epoch, splits_to_eval):
+    # the rest of tester.test, after the embeddings are computed
+    tester.embeddings_and_labels = embeddings_and_labels
+    tester.maybe_visualize(tester.embeddings_and_labels, epoch)
+    tester.all_accuracies = defaultdict(dict)
+    for split_name in splits_to_eval:
+        logging.info('Computing accuracy for the %s split'%split_name)
+        tester.all_accuracies[split_name]["epoch"] = epoch
+        tester.do_knn_and_accuracies(tester.all_accuracies[split_name], tester.embeddings_and_labels, split_name)
+    tester.end_of_testing_hook(tester) if tester.end_of_testing_hook else logging.info(tester.all_accuracies)
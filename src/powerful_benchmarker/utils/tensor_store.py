@@ -0,0 +1,174 @@
+#! /usr/bin/env python3
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import torch
+import pytorch_metric_learning.utils.common_functions as pml_cf
+from . import experiment_manifest
+from .checkpoint_writer import save_atomically
+
+OBJECTS_FOLDER_NAME = "checkpoint_objects"
+INDEX_FILENAME = "index.json"
+MANIFEST_KEY = "tensor_store_manifest"
+OBJECTS_FOLDER_KEY = "tensor_store_objects_folder"
+OBJECT_KEY = "tensor_store_object"
+
+# A checkpoint saved by a TensorStore has the usual filename (like trunk_5.pth), but each tensor in it
+# is replaced by the hash of its contents. The tensors are saved in the objects folder, one file per hash,
+# so a tensor that doesn't change between checkpoints (like a frozen layer) is only written once.
+# The index in the objects folder records which objects each checkpoint refers to.
+# An object is deleted when the last checkpoint that refers to it is deleted.
+
+
+def tensor_hash(x):
+    x = x.detach().to("cpu").contiguous()
+    # numpy doesn't have bfloat16
+    data = x.view(torch.int16).numpy() if x.dtype == torch.bfloat16 else x.numpy()
+    h = hashlib.sha256("{}{}".format(x.dtype, tuple(x.shape)).encode())
+    h.update(data)
+    return h.hexdigest()
+
+
+def map_tensors(x, fn):
+    if torch.is_tensor(x):
+        return fn(x)
+    if isinstance(x, dict):
+        if set(x.keys()) == {OBJECT_KEY}:
+            return fn(x)
+        y = type(x)((k, map_tensors(v, fn)) for k, v in x.items())
+        # module state dicts store their version numbers here
+        if hasattr(x, "_metadata"):
+            y._metadata = x._metadata
+        return y
+    if isinstance(x, (list, tuple)):
+        return type(x)(map_tensors(v, fn) for v in x)
+    return x
+
+
+def load_state_dict(path, map_location=None):
+    """
+    Loads a checkpoint file. Checkpoints saved by a TensorStore are resolved, and other checkpoints are loaded as usual.
+    """
+    obj = torch.load(path, map_location=map_location)
+    if not (isinstance(obj, dict) and MANIFEST_KEY in obj):
+        return obj
+    objects_folder = os.path.join(os.path.dirname(path), obj[OBJECTS_FOLDER_KEY])
+    loaded = {}
+    def load_object(x):
+        object_hash = x[OBJECT_KEY]
+        if object_hash not in loaded:
+            object_path = os.path.join(objects_folder, "%s.pt"%object_hash)
+            if not os.path.isfile(object_path):
+                raise IOError("{} refers to {}, which doesn't exist".format(path, object_path))
+            loaded[object_hash] = torch.load(object_path, map_location=map_location)
+        return loaded[object_hash]
+    return map_tensors(obj[MANIFEST_KEY], load_object)
+
+
+# the same as pytorch_metric_learning's load_model, but it also loads checkpoints saved by a TensorStore
+def load_model(model_def, model_filename, device):
+    state_dict = load_state_dict(model_filename, device)
+    try:
+        model_def.load_state_dict(state_dict)
+    except KeyError:
+        # original saved file with DataParallel
+        model_def.load_state_dict(collections.OrderedDict((k[7:], v) for k, v in state_dict.items()))
+
+
+def load_dict_of_models(input_dict, suffix, folder, device, **kwargs):
+    def operation(k, v, model_path):
+        load_model(v, model_path, device)
+    pml_cf.operate_on_dict_of_models(input_dict, suffix, folder, operation, "LOAD", **kwargs)
+
+
+class TensorStore:
+    """
+    Saves and deletes checkpoints, deduplicating their tensors by content hash.
+    save_state_dict and delete_checkpoint can be passed to CheckpointWriter and BackgroundEvaluator.
+    Saving, deleting and garbage collection are serialized with a lock file,
+    so split schemes running in parallel can share the objects folder.
+    """
+    def __init__(self, objects_folder):
+        self.objects_folder = objects_folder
+        self.index_path = os.path.join(objects_folder, INDEX_FILENAME)
+        os.makedirs(objects_folder, exist_ok=True)
+
+    def object_path(self, object_hash):
+        return os.path.join(self.objects_folder, "%s.pt"%object_hash)
+
+    def index_key(self, path):
+        return os.path.relpath(path, self.objects_folder)
+
+    def lock(self):
+        return experiment_manifest.file_lock("%s.lock"%self.index_path)
+
+    def load_index(self):
+        if not os.path.isfile(self.index_path):
+            return {}
+        with open(self.index_path, "r") as f:
+            return json.load(f)
+
+    def save_index(self, index):
+        tmp_path = "%s.tmp%d"%(self.index_path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def save_state_dict(self, state_dict, path):
+        tensors = {}
+        def to_object(x):
+            object_hash = tensor_hash(x)
+            tensors[object_hash] = x
+            return {OBJECT_KEY: object_hash}
+        manifest = {MANIFEST_KEY: map_tensors(state_dict, to_object),
+                    OBJECTS_FOLDER_KEY: os.path.relpath(self.objects_folder, os.path.dirname(path))}
+        with self.lock():
+            index = self.load_index()
+            # the references are recorded before the checkpoint is written, so an interrupted save can only leak objects
+            prev_objects = set(index.get(self.index_key(path), []))
+            index[self.index_key(path)] = sorted(tensors.keys())
+            self.save_index(index)
+            num_new = 0
+            for object_hash, x in tensors.items():
+                object_path = self.object_path(object_hash)
+                if not os.path.isfile(object_path):
+                    # copied, so that a view doesn't save the whole storage it's part of
+                    save_atomically(x.detach().to("cpu", copy=True), object_path)
+                    num_new += 1
+            save_atomically(manifest, path)
+            self.delete_unreferenced_objects(index, prev_objects)
+        logging.info("Saved {} with {} new tensors out of {}".format(path, num_new, len(tensors)))
+
+    def delete_checkpoint(self, model_folder, keys, suffix):
+        with self.lock():
+            index = self.load_index()
+            candidates = set()
+            for k in keys:
+                model_path = pml_cf.modelpath_creator(model_folder, k, suffix)
+                if os.path.exists(model_path): os.remove(model_path)
+                candidates.update(index.pop(self.index_key(model_path), []))
+            self.delete_unreferenced_objects(index, candidates)
+            self.save_index(index)
+
+    def delete_unreferenced_objects(self, index, candidates):
+        referenced = set()
+        for v in index.values():
+            referenced.update(v)
+        for object_hash in candidates - referenced:
+            object_path = self.object_path(object_hash)
+            if os.path.exists(object_path): os.remove(object_path)
+
+    def collect_garbage(self):
+        """
+        Forgets checkpoints that were deleted without going through the store,
+        and deletes the objects that no remaining checkpoint refers to.
+        """
+        with self.lock():
+            index = self.load_index()
+            index = {k: v for k, v in index.items() if os.path.isfile(os.path.join(self.objects_folder, k))}
+            all_objects = {os.path.splitext(x)[0] for x in os.listdir(self.objects_folder) if x.endswith(".pt")}
+            self.delete_unreferenced_objects(index, all_objects)
+            self.save_index(index)
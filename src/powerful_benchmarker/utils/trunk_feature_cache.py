@@ -0,0 +1,87 @@
+#! /usr/bin/env python3
+
+import torch
+import numpy as np
+import hashlib
+import logging
+import os
+import tqdm
+import pytorch_metric_learning.utils.common_functions as pml_cf
+from . import common_functions as c_f, dataset_utils as d_u
+
+
+def get_features_key(trunk_hash, transform, dataset, labels):
+    h = hashlib.md5()
+    for x in [trunk_hash, repr(transform), type(dataset).__name__, d_u.get_dataset_params_description(dataset), str(len(dataset))]:
+        h.update(x.encode("utf-8"))
+    h.update(np.ascontiguousarray(labels).tobytes())
+    return h.hexdigest()
+
+
+def compute_features(trunk, dataset, output_path, batch_size, num_workers, collate_fn, data_and_label_getter, device):
+    logging.info("Computing trunk features for {} samples, and saving them to {}".format(len(dataset), output_path))
+    dataloader = pml_cf.get_eval_dataloader(dataset, batch_size, num_workers, collate_fn)
+    trunk = torch.nn.DataParallel(trunk).to(device)
+    trunk.eval()
+    tmp_path = "{}.tmp.npy".format(output_path)
+    features, s = None, 0
+    with torch.no_grad():
+        for data in tqdm.tqdm(dataloader):
+            img, _ = data_and_label_getter(data)
+            curr_features = trunk(img.to(device)).cpu().numpy()
+            if features is None:
+                features = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(len(dataset), curr_features.shape[1]))
+            features[s:s+len(curr_features)] = curr_features
+            s += len(curr_features)
+    features.flush()
+    del features
+    os.replace(tmp_path, output_path)
+
+
+class TrunkFeatureDataset(torch.utils.data.Dataset):
+    """
+    Returns precomputed trunk features instead of images. Attributes that are not
+    defined here, like the labels, are looked up on source_dataset.
+    """
+    def __init__(self, source_dataset, features_path, labels, data_and_label_getter_keys=None):
+        self.source_dataset = source_dataset
+        self.features_path = features_path
+        self.feature_labels = labels
+        self.data_and_label_getter_keys = data_and_label_getter_keys
+        self.features = None
+
+    def __len__(self):
+        return len(self.feature_labels)
+
+    def __getitem__(self, idx):
+        # opened lazily so that each dataloader worker maps the same file instead of copying it
+        if self.features is None:
+            self.features = np.load(self.features_path, mmap_mode="r")
+        data, label = torch.from_numpy(np.array(self.features[idx])), self.feature_labels[idx]
+        return d_u.format_data_and_label(data, label, self.data_and_label_getter_keys)
+
+    def __getattr__(self, name):
+        if name == "source_dataset":
+            raise AttributeError(name)
+        return getattr(self.source_dataset, name)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["features"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+def get_trunk_feature_dataset(trunk, trunk_hash, dataset, transform, cache_folder, split_manager, **compute_kwargs):
+    labels = np.asarray(d_u.get_dataset_attr(dataset, split_manager.labels_attr_name))
+    key = get_features_key(trunk_hash, transform, dataset, labels)
+    features_path = os.path.join(cache_folder, "{}.npy".format(key))
+    if os.path.isfile(features_path):
+        logging.info("Loading trunk features from {}".format(features_path))
+    else:
+        c_f.makedir_if_not_there(cache_folder)
+        compute_features(trunk, d_u.get_dataset_with_transform(dataset, transform), features_path,
+                        data_and_label_getter=split_manager.data_and_label_getter, **compute_kwargs)
+    return TrunkFeatureDataset(dataset, features_path, labels, split_manager.data_and_label_getter_keys)
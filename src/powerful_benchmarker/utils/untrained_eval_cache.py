@@ -0,0 +1,66 @@
+#! /usr/bin/env python3
+
+import numpy as np
+import hashlib
+import json
+import logging
+import os
+from collections import defaultdict
+from . import common_functions as c_f, dataset_utils as d_u
+
+# untrained embedders are initialized with this seed, so that their evaluations can be reused
+UNTRAINED_EMBEDDER_SEED = 0
+
+
+# description_suffixes doesn't include the settings of the accuracy calculator, like k and avg_of_avgs
+def get_tester_description(tester, tester_args):
+    accuracy_calculator = tester.accuracy_calculator
+    description = {"suffixes": tester.description_suffixes("accuracies"),
+                    "accuracy_calculator": type(accuracy_calculator).__name__,
+                    "metrics": sorted(accuracy_calculator.get_curr_metrics()),
+                    "k": getattr(accuracy_calculator, "k", None),
+                    "avg_of_avgs": getattr(accuracy_calculator, "avg_of_avgs", None),
+                    "set_min_label_to_zero": getattr(tester, "set_min_label_to_zero", None),
+                    "tester_args": tester_args}
+    return json.dumps(description, sort_keys=True, default=str)
+
+
+def get_key(trunk, embedder, transform, dataset_dict, splits_to_eval, tester, labels_attr_name, tester_args=None):
+    h = hashlib.md5()
+    for x in [c_f.get_state_dict_hash(trunk), c_f.get_state_dict_hash(embedder), repr(transform), get_tester_description(tester, tester_args)]:
+        h.update(x.encode("utf-8"))
+    for split_name in sorted(splits_to_eval):
+        dataset = dataset_dict[split_name]
+        underlying = d_u.get_underlying_dataset(dataset)
+        h.update("{}_{}_{}".format(split_name, type(underlying).__name__, len(underlying)).encode("utf-8"))
+        h.update(np.ascontiguousarray(getattr(dataset, "indices", [])).tobytes())
+        h.update(np.ascontiguousarray(d_u.get_dataset_labels(dataset, labels_attr_name)).tobytes())
+    return h.hexdigest()
+
+
+def save(folder, key, embeddings_and_labels, all_accuracies):
+    c_f.makedir_if_not_there(folder)
+    arrays = {}
+    for split_name, (embeddings, labels) in embeddings_and_labels.items():
+        arrays["embeddings|{}".format(split_name)] = embeddings
+        arrays["labels|{}".format(split_name)] = labels
+    accuracies = json.dumps({k: {m: float(a) for m, a in v.items()} for k, v in all_accuracies.items()})
+    path = os.path.join(folder, "{}.npz".format(key))
+    tmp_path = "{}.tmp.npz".format(path)
+    np.savez(tmp_path, accuracies=accuracies, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load(folder, key):
+    path = os.path.join(folder, "{}.npz".format(key))
+    if not os.path.isfile(path):
+        return None
+    logging.info("Loading cached untrained evaluation from {}".format(path))
+    embeddings_and_labels = {}
+    with np.load(path) as saved:
+        for k in saved.files:
+            if k.startswith("embeddings|"):
+                split_name = k.split("|", 1)[1]
+                embeddings_and_labels[split_name] = (saved[k], saved["labels|{}".format(split_name)])
+        all_accuracies = defaultdict(dict, json.loads(str(saved["accuracies"])))
+    return embeddings_and_labels, all_accuracies